@@ -0,0 +1,88 @@
+"""Micro-benchmark: binary wire protocol vs the old space separated text messages.
+
+Each scenario measures the work done by the role that receives the message:
+acceptors only need the header of a PHASE2A (the batch stays encoded), while
+learners decode every value of a DECISION. Binary batches also carry the
+client id and sequence number of every request, which the text format lacked.
+
+Usage: python3 bench_codec.py [iterations]
+"""
+import sys
+import timeit
+
+from mypaxos import (PHASE2A, PHASE2B, DECISION, Request, encode_message, decode_messages,
+                     encode_batch, decode_batch_columns, decode_values)
+
+
+# The text format the roles used before the binary protocol
+def text_encode(kind, rnd, instance, sender, batch):
+    batch = [request.value for request in batch]
+    if kind == "PHASE2B":
+        return f"PHASE2B {rnd} {instance} {sender}".encode()
+    if kind == "DECISION":
+        return f"DECISION {instance} {','.join(batch)}".encode()
+    return f"PHASE2A {rnd} {instance} {','.join(batch)}".encode()
+
+def text_decode(data):
+    msg = data.decode().strip()
+    if msg.startswith("END_"):
+        return None
+    elif msg.startswith("DECISION"):
+        _, instance, value = msg.split()
+        return int(instance), value.split(",")
+    elif msg.startswith("HEARTBEAT"):
+        return None
+    elif msg.startswith("PHASE1B"):
+        return None
+    elif msg.startswith("PHASE2A"):
+        _, rnd, instance, value = msg.split()
+        return int(rnd), int(instance), value
+    elif msg.startswith("PHASE2B"):
+        _, rnd, instance, sender = msg.split()
+        return int(rnd), int(instance), sender
+
+
+def binary_encode(kind, rnd, instance, sender, batch):
+    if kind == "PHASE2B":
+        return encode_message(PHASE2B, sender, rnd, instance)
+    msg_type = PHASE2A if kind == "PHASE2A" else DECISION
+    return encode_message(msg_type, sender, rnd, instance, payload=encode_batch(batch))
+
+def binary_decode(data):
+    for msg in decode_messages(data):  # One message per datagram here, as the roles read them
+        if msg.type == DECISION:
+            client_ids, seqs, values, ends = decode_batch_columns(msg.payload)
+            return msg.instance, client_ids, seqs, decode_values(values)
+        return msg
+
+
+def bench(func, iterations):
+    seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+    return seconds / iterations * 1e9
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    def requests(count):
+        return [Request(1, seq, str(10000 + seq)) for seq in range(1, count + 1)]
+
+    scenarios = [
+        ("PHASE2B", []),
+        ("PHASE2A", requests(1)),
+        ("PHASE2A", requests(64)),
+        ("DECISION", requests(1)),
+        ("DECISION", requests(64)),
+        ("DECISION", requests(1000)),
+    ]
+    print(f"{'message':<16}{'format':<8}{'bytes':>8}{'encode ns':>12}{'decode ns':>12}")
+    for kind, batch in scenarios:
+        label = f"{kind} x{len(batch)}" if batch else kind
+        for name, encode, decode in (("text", text_encode, text_decode),
+                                     ("binary", binary_encode, binary_decode)):
+            data = encode(kind, 1234, 5678, 3, batch)
+            encode_ns = bench(lambda: encode(kind, 1234, 5678, 3, batch), iterations)
+            decode_ns = bench(lambda: decode(data), iterations)
+            print(f"{label:<16}{name:<8}{len(data):>8}{encode_ns:>12.0f}{decode_ns:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,286 @@
 import socket
 import struct
+import json
+import logging
+import math
 import time
-import threading
 import sys
 import os
-import random
-from collections import deque
-import traceback
+import heapq
+import selectors
+import mmap
+import zlib
+from collections import deque, namedtuple, OrderedDict, Counter
+from itertools import islice, compress
+from array import array
+
+# Events that happen for every message are logged at DEBUG, so with the default
+# log_level they cost a level check and no formatting
+logger = logging.getLogger("mypaxos")
+
+MAX_DATAGRAM = 65000  # Keep every message within a single UDP datagram
+
+# Wire protocol: a fixed header followed by a length-prefixed payload
+PROTOCOL_VERSION = 1
+
+PHASE1A = 1
+PHASE1B = 2
+PHASE2A = 3
+PHASE2B = 4
+DECISION = 5
+HEARTBEAT = 6
+CLIENT_VALUE = 7
+CLIENT_END = 8
+CATCHUP_REQUEST = 9
+SHUTDOWN = 10
+COMMIT = 11
+CATCHUP_REPLY = 12
+CLIENT_ACK = 13
+SNAPSHOT = 14
+PACE = 15
+
+MESSAGE_NAMES = {
+    PHASE1A: "PHASE1A",
+    PHASE1B: "PHASE1B",
+    PHASE2A: "PHASE2A",
+    PHASE2B: "PHASE2B",
+    DECISION: "DECISION",
+    HEARTBEAT: "HEARTBEAT",
+    CLIENT_VALUE: "CLIENT_VALUE",
+    CLIENT_END: "CLIENT_END",
+    CATCHUP_REQUEST: "CATCHUP_REQUEST",
+    SHUTDOWN: "SHUTDOWN",
+    COMMIT: "COMMIT",
+    CATCHUP_REPLY: "CATCHUP_REPLY",
+    CLIENT_ACK: "CLIENT_ACK",
+    SNAPSHOT: "SNAPSHOT",
+    PACE: "PACE",
+}
+
+FLAG_ALL_INSTANCES = 1  # PHASE1A: the promise covers this instance and every later one
+FLAG_LAST_CHUNK = 2  # CATCHUP_REPLY: last datagram of the answer to a request
+FLAG_ANY = 4  # PHASE2A: opens a fast round for this instance and every later one
+
+# version, type, flags, sender id, ballot, instance, aux, payload length
+HEADER = struct.Struct("!BBBHQQII")
+BATCH_HEADER = struct.Struct("!HI")  # number of End entries, number of requests in a batch
+REPORT = struct.Struct("!QQI")  # PHASE1B report: instance, accepted round, batch length
+END_ENTRY = struct.Struct("!HI")  # client id, value count
+REQUEST_ID_SIZE = 6  # client id (H) and sequence number (I), stored as two columns
+SEQ_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'  # array type of the sequence number column
+SWAP_COLUMNS = sys.byteorder == 'little'  # The columns are big-endian on the wire
+SMALL_BATCH = 16  # Batches of up to this many requests and no End entry are packed with one struct call
+SMALL_BATCHES = [struct.Struct(f"!HI{count}H{count}I") for count in range(SMALL_BATCH + 1)]  # Header and columns
+RESPONDER = struct.Struct("!H")  # CATCHUP_REQUEST: acceptor asked to answer
+COMMIT_ENTRY = struct.Struct("!QQI")  # COMMIT: instance, round its batch was chosen in, crc32 of the batch
+# Snapshot entry: client id, high-water mark, END count + 1 (0: no END yet), number of seqs above the mark
+SNAPSHOT_CLIENT = struct.Struct("!HIII")
+
+# A decoded message. aux is the report count in PHASE1B, the value count in
+# CLIENT_END and SHUTDOWN, the sequence number in CLIENT_VALUE and the number of
+# instances asked for in CATCHUP_REQUEST. In PACE the sender is a group, not a proposer.
+# The payload is left encoded: a batch (PHASE2A, DECISION, CLIENT_ACK, and PHASE2B
+# in a fast round, where acceptors vote for values of their own choosing), commit entries
+# (COMMIT, the latest decisions, so that a lost COMMIT is made up by the next), reports (PHASE1B,
+# CATCHUP_REPLY), a snapshot (SNAPSHOT, whose instance is the first one it does
+# not cover) or a client value, decoded only by the roles that need it.
+Message = namedtuple('Message', 'type flags sender ballot instance aux payload')
+
+# A client value, identified by its client and the client's sequence number
+# (1, 2, ...), so that equal values sent by different clients stay distinct
+Request = namedtuple('Request', 'client_id seq value')
+
+# Marks the end of a client's input inside a batch
+End = namedtuple('End', 'client_id count')
+
+
+def encode_message(msg_type, sender=0, ballot=0, instance=0, aux=0, payload=b"", flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, sender, ballot, instance,
+                       aux, len(payload)) + payload
+
+def decode_messages(data):
+    """Messages packed in a datagram (bytes or a memoryview of the receive buffer).
+    Headers are parsed in place, only payloads are copied out of the buffer."""
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < HEADER.size:
+            raise ValueError("Truncated header")
+        version, msg_type, flags, sender, ballot, instance, aux, length = HEADER.unpack_from(data, offset)
+        if version != PROTOCOL_VERSION:
+            raise ValueError(f"Unsupported protocol version {version}")
+        start = offset + HEADER.size
+        offset = start + length
+        if offset > len(data):
+            raise ValueError("Payload length mismatch")
+        yield Message(msg_type, flags, sender, ballot, instance, aux, bytes(data[start:offset]))
+
+def entry_size(entry):
+    """Bytes the entry adds to an encoded batch"""
+    if entry.__class__ is End:
+        return END_ENTRY.size
+    return REQUEST_ID_SIZE + len(entry.value.encode()) + 1
+
+def encode_batch(batch):
+    """End entries first, then the client ids and sequence numbers of the
+    requests as two columns, then the values separated by newlines.
+
+    Values are lines of client input, so they never contain a newline, which
+    lets a whole batch be joined and split in one call.
+    """
+    ends = [entry for entry in batch if entry.__class__ is End]
+    requests = [entry for entry in batch if entry.__class__ is not End] if ends else batch
+    client_ids, seqs, values = zip(*requests) if requests else ((), (), ())
+    if not ends and len(requests) <= SMALL_BATCH:
+        return SMALL_BATCHES[len(requests)].pack(0, len(requests), *client_ids, *seqs) + "\n".join(values).encode()
+    client_ids = array('H', client_ids)
+    seqs = array(SEQ_TYPECODE, seqs)
+    if SWAP_COLUMNS:
+        client_ids.byteswap()
+        seqs.byteswap()
+    return (BATCH_HEADER.pack(len(ends), len(requests)) +
+            b"".join([END_ENTRY.pack(*end) for end in ends]) +
+            client_ids.tobytes() + seqs.tobytes() + "\n".join(values).encode())
+
+def decode_batch_columns(payload):
+    """(client ids, sequence numbers, values, End entries) of a batch, with the
+    values left encoded for the roles that only look at the ids"""
+    end_count, request_count = BATCH_HEADER.unpack_from(payload)
+    if not end_count and request_count <= SMALL_BATCH:
+        fields = SMALL_BATCHES[request_count].unpack_from(payload)
+        return (fields[2:2 + request_count], fields[2 + request_count:],
+                payload[BATCH_HEADER.size + request_count * REQUEST_ID_SIZE:], ())
+    ids_start = BATCH_HEADER.size + end_count * END_ENTRY.size
+    seqs_start = ids_start + 2 * request_count
+    values_start = ids_start + request_count * REQUEST_ID_SIZE
+    client_ids = array('H', payload[ids_start:seqs_start])
+    seqs = array(SEQ_TYPECODE, payload[seqs_start:values_start])
+    if SWAP_COLUMNS:
+        client_ids.byteswap()
+        seqs.byteswap()
+    ends = ()
+    if end_count:
+        ends = tuple(End(*fields) for fields in END_ENTRY.iter_unpack(payload[BATCH_HEADER.size:ids_start]))
+    return client_ids, seqs, payload[values_start:], ends
+
+def decode_values(values):
+    """Values of a batch from the encoded values decode_batch_columns returns"""
+    return values.decode().split("\n")
+
+def decode_batch(payload):
+    """Requests in batch order followed by the End entries"""
+    client_ids, seqs, values, ends = decode_batch_columns(payload)
+    if not client_ids:
+        return ends
+    return tuple(map(Request, client_ids, seqs, decode_values(values))) + ends
+
+def batch_ids(payload):
+    """The batch without its values, all a client needs to see which of its requests are decided"""
+    end_count, request_count = BATCH_HEADER.unpack_from(payload)
+    return payload[:BATCH_HEADER.size + end_count * END_ENTRY.size + request_count * REQUEST_ID_SIZE]
+
+def client_entries(payload, client_id):
+    """Sequence numbers of the requests of one client in a batch, and its End entries"""
+    client_ids, seqs, _, ends = decode_batch_columns(payload)
+    own_seqs = list(compress(seqs, map(client_id.__eq__, client_ids)))
+    return own_seqs, [end for end in ends if end.client_id == client_id]
+
+def encode_reports(reports):
+    """PHASE1B/CATCHUP_REPLY payload from (instance, accepted round, encoded batch) reports"""
+    return b"".join(REPORT.pack(instance, accepted_rnd, len(batch)) + batch
+                    for instance, accepted_rnd, batch in reports)
+
+def decode_reports(payload):
+    reports = []
+    offset = 0
+    while offset < len(payload):
+        instance, accepted_rnd, length = REPORT.unpack_from(payload, offset)
+        offset += REPORT.size
+        reports.append((instance, accepted_rnd, payload[offset:offset + length]))
+        offset += length
+    return reports
+
+class RequestSet:
+    """Set of request ids kept as a high-water mark per client: every sequence
+    number up to the mark is in the set, plus the few above it that arrived early"""
+
+    def __init__(self):
+        self.marks = {}  # client id -> highest seq with every seq up to it in the set
+        self.above = {}  # client id -> seqs in the set beyond the mark
+
+    def __contains__(self, request):
+        if request.seq <= self.marks.get(request.client_id, 0):
+            return True
+        above = self.above.get(request.client_id)
+        return above is not None and request.seq in above
+
+    def add(self, request):
+        """Add the request's id, return False if it was already in the set"""
+        return self.add_id(request.client_id, request.seq)
+
+    def add_id(self, client_id, seq):
+        """Add a request id, return False if it was already in the set"""
+        if seq <= self.marks.get(client_id, 0):
+            return False
+        above = self.above.setdefault(client_id, set())
+        if seq in above:
+            return False
+        above.add(seq)
+        mark = self.marks.get(client_id, 0)
+        while mark + 1 in above:
+            mark += 1
+            above.discard(mark)
+        self.marks[client_id] = mark
+        return True
+
+    def update(self, other):
+        """Add every request id of another RequestSet"""
+        for client_id in set(other.marks) | set(other.above):
+            mark = max(self.marks.get(client_id, 0), other.marks.get(client_id, 0))
+            above = {seq for seq in self.above.get(client_id, ()) if seq > mark}
+            above.update(seq for seq in other.above.get(client_id, ()) if seq > mark)
+            while mark + 1 in above:
+                mark += 1
+                above.discard(mark)
+            self.marks[client_id] = mark
+            self.above[client_id] = above
+
+    def __len__(self):
+        return sum(self.marks.values()) + sum(len(above) for above in self.above.values())
+
+def encode_snapshot(requests, counts):
+    """SNAPSHOT payload: the ids of the delivered requests and the value counts
+    of the clients whose END was delivered, all a replica needs to skip the
+    instances the snapshot covers"""
+    data = []
+    for client_id in sorted(set(requests.marks) | set(counts)):
+        above = sorted(requests.above.get(client_id, ()))
+        data.append(SNAPSHOT_CLIENT.pack(client_id, requests.marks.get(client_id, 0),
+                                         counts.get(client_id, -1) + 1, len(above)))
+        data.append(struct.pack(f"!{len(above)}I", *above))
+    return b"".join(data)
+
+def decode_snapshot(payload):
+    """RequestSet and End entries of a SNAPSHOT payload"""
+    requests = RequestSet()
+    ends = []
+    offset = 0
+    while offset < len(payload):
+        client_id, mark, count, above_count = SNAPSHOT_CLIENT.unpack_from(payload, offset)
+        offset += SNAPSHOT_CLIENT.size
+        requests.marks[client_id] = mark
+        requests.above[client_id] = set(struct.unpack_from(f"!{above_count}I", payload, offset))
+        offset += 4 * above_count
+        if count:
+            ends.append(End(client_id, count - 1))
+    return requests, ends
+
+def parse_setting(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
 
 def load_config(config_path):
     config = {}
@@ -16,23 +290,87 @@ def load_config(config_path):
                 line = line.strip()
                 if line:
                     parts = line.split()
+                    if len(parts) == 2:  # Tuning option: key value
+                        key, value = parts
+                        config[key] = parse_setting(value)
+                        logger.info("Loaded setting: %s -> %s", key, config[key])
+                        continue
                     if len(parts) != 3:
-                        print(f"Warning: Invalid line in config '{line}'. Expected format: key ip port.", file=sys.stderr)
+                        logger.warning("Invalid line in config '%s'. Expected format: key ip port or key value.", line)
                         continue
                     key, ip, port = parts
                     config[key] = (ip, int(port))
-                    print(f"Loaded config: {key} -> ({ip}, {port})", file=sys.stderr)
+                    logger.info("Loaded config: %s -> (%s, %s)", key, ip, port)
+        quorum_sizes(config)  # Refuse quorums that do not intersect
+        if config.get('fast_paxos'):
+            if not config.get('stable_leader', 1):
+                raise ValueError("fast_paxos needs stable_leader 1")
+            fast_quorum_size(config)
+        if config.get('groups', 1) > 1:
+            # Leaders fill the log of a group that falls behind, so learners can merge
+            # the logs: in fast rounds the acceptors pick the instances themselves
+            if config.get('fast_paxos') or not config.get('stable_leader', 1):
+                raise ValueError("groups needs stable_leader 1 and no fast_paxos")
         return config
     except Exception as e:
-        print(f"Error loading config: {e}", file=sys.stderr)
+        logger.error("Error loading config: %s", e)
         sys.exit(1)
 
+def quorum_sizes(config):
+    """(number of acceptors, Phase 1 quorum, Phase 2 quorum) of a config.
+
+    As in Flexible Paxos only quorums of different phases need to intersect,
+    Q1 + Q2 > N: a small Phase 2 quorum speeds up every instance at the cost of
+    a larger Phase 1 quorum when the leader changes. Without settings both are
+    majorities, and a quorum left unset is the smallest one that fits the other.
+    """
+    acceptor_count = config.get('acceptor_count', 3)
+    if 'phase1_quorum' in config:
+        phase2_quorum = config.get('phase2_quorum', acceptor_count - config['phase1_quorum'] + 1)
+    else:
+        phase2_quorum = config.get('phase2_quorum', acceptor_count // 2 + 1)
+    phase1_quorum = config.get('phase1_quorum', acceptor_count - phase2_quorum + 1)
+    if not (1 <= phase1_quorum <= acceptor_count and 1 <= phase2_quorum <= acceptor_count):
+        raise ValueError(f"Quorums must be between 1 and acceptor_count ({acceptor_count})")
+    if phase1_quorum + phase2_quorum <= acceptor_count:
+        raise ValueError(f"phase1_quorum + phase2_quorum must exceed acceptor_count "
+                         f"({phase1_quorum} + {phase2_quorum} <= {acceptor_count})")
+    return acceptor_count, phase1_quorum, phase2_quorum
+
+def fast_quorum_size(config):
+    """Acceptors that must accept a client value in a fast round for it to be chosen.
+
+    Acceptors pick the values of a fast round themselves, so the leader recovering
+    an instance must be able to tell from a Phase 1 quorum which value a fast quorum
+    may have chosen: any two fast quorums and a Phase 1 quorum intersect, Q1 + 2 Qf > 2N.
+    """
+    acceptor_count, phase1_quorum, _ = quorum_sizes(config)
+    fast_quorum = config.get('fast_quorum', acceptor_count - (phase1_quorum + 1) // 2 + 1)
+    if not 1 <= fast_quorum <= acceptor_count:
+        raise ValueError(f"fast_quorum must be between 1 and acceptor_count ({acceptor_count})")
+    if phase1_quorum + 2 * fast_quorum <= 2 * acceptor_count:
+        raise ValueError(f"phase1_quorum + 2 * fast_quorum must exceed 2 * acceptor_count "
+                         f"({phase1_quorum} + 2 * {fast_quorum} <= {2 * acceptor_count})")
+    return fast_quorum
+
+def group_config(config, group):
+    """Config of one of the independent Paxos groups: every address of the config
+    moved up by group * group_port_stride ports, the settings shared. The leaders
+    of all groups tell each other their log tip on the pace address, one stride
+    above the proposers of the last group."""
+    stride = config.get('group_port_stride', 10)
+    derived = {key: (value[0], value[1] + group * stride) if isinstance(value, tuple) else value
+               for key, value in config.items()}
+    derived['group'] = group
+    ip, port = config['proposers']
+    derived['pace'] = (ip, port + config.get('groups', 1) * stride)
+    return derived
+
 def create_multicast_socket():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**30)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2**30)
-    sock.settimeout(0.02)
     ttl = struct.pack('b', 2)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
     return sock
@@ -43,449 +381,2345 @@ def join_multicast_group(sock, multicast_addr, port):
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
     return sock
 
-def proposer(CONFIG, proposer_id):
-    proposer_socket = create_multicast_socket()
-    learner_socket = create_multicast_socket()
-    
-    proposer_addr, proposer_port = CONFIG['proposers']
-    learner_addr, learner_port = CONFIG['learners']
-    
-    join_multicast_group(proposer_socket, proposer_addr, proposer_port)
-    learner_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-    
-    proposer_socket.settimeout(0.5)
-    min_backoff = 0.05
-    max_backoff = 1.0
-    current_backoff = min_backoff
-    
-    print(f"Starting Proposer {proposer_id}", file=sys.stderr)
-    
+class Histogram:
+    """Latency distribution in buckets a quarter octave wide from one microsecond:
+    constant cost per sample, percentiles within 19% of the exact value"""
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[int(4 * math.log2(seconds * 1e6)) if seconds > 1e-6 else 0] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        rank = self.count * p / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / 4) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """Count, and mean, p50, p99 and max in milliseconds"""
+        return {'count': self.count, 'mean': round(self.total / max(self.count, 1) * 1000, 3),
+                'p50': round(self.percentile(50) * 1000, 3), 'p99': round(self.percentile(99) * 1000, 3),
+                'max': round(self.max * 1000, 3)}
+
+class Metrics:
+    """Counters, gauges and latency histograms of the roles sharing an event loop,
+    named after the role, e.g. proposer.decisions"""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.gauges = {}  # name -> function returning the current value
+        self.histograms = {}  # name -> Histogram
+        self.last_report = (None, Counter())  # (time, counters) of the previous report, for rates
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def snapshot(self):
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'gauges': {name: read() for name, read in sorted(self.gauges.items())},
+            'latency_ms': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+        }
+
+    def report(self, current_time):
+        """One line for the stats dump: counters with their rate since the previous line"""
+        last_time, last_counters = self.last_report
+        elapsed = current_time - last_time if last_time is not None else None
+        parts = []
+        for name, value in sorted(self.counters.items()):
+            if elapsed:
+                parts.append(f"{name} {value} ({(value - last_counters[name]) / elapsed:.0f}/s)")
+            else:
+                parts.append(f"{name} {value}")
+        parts.extend(f"{name} {read()}" for name, read in sorted(self.gauges.items()))
+        for name, histogram in sorted(self.histograms.items()):
+            summary = histogram.summary()
+            parts.append(f"{name} p50 {summary['p50']:.2f} p99 {summary['p99']:.2f} max {summary['max']:.2f} ms")
+        self.last_report = (current_time, Counter(self.counters))
+        return ", ".join(parts)
+
+class Timer:
+    """Handle returned by EventLoop.call_at, call_later and call_every"""
+    __slots__ = ('when', 'callback', 'interval', 'cancelled')
+
+    def __init__(self, when, callback, interval=None):
+        self.when = when
+        self.callback = callback
+        self.interval = interval  # Re-armed every interval seconds when set
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class EventLoop:
+    """Single-threaded runtime shared by the roles of a process.
+
+    Sockets are multiplexed with a selector and timers are kept in a heap, so a
+    callback runs as soon as its datagram arrives or its deadline passes and
+    nothing ever polls or sleeps. Callbacks must not block. The loop runs until
+    every reader has been removed.
+
+    Datagrams are read into one preallocated buffer per socket, and messages sent
+    during an iteration are queued and leave together before the loop waits again,
+    those to the same group packed into as few datagrams as fit in an MTU.
+
+    The roles record what they do in metrics, which serve_stats dumps periodically
+    and serves over UDP.
+    """
+    DRAIN_LIMIT = 64  # Datagrams read from one socket before other work gets a turn
+    COALESCE_BYTES = 1472  # UDP payload of a 1500 byte Ethernet frame
+    RECEIVE_BUFFER = 2**16
+
+    def __init__(self):
+        # poll also accepts regular files, which stdin is when a client reads from a redirected file
+        self.selector = selectors.PollSelector()
+        self.timers = []
+        self.outgoing = {}  # (socket, group address) -> messages queued in this iteration
+        self.syscalls = Counter()  # select, recvfrom_into and sendto calls, to measure the cost per value
+        self.metrics = Metrics()
+        self.daemons = set()  # Readers that do not keep the loop running
+
+    def time(self):
+        return time.time()
+
+    def open_socket(self, group=None):
+        """Socket that sends to multicast groups and, given a group address, receives from it"""
+        sock = create_multicast_socket()
+        if group:
+            join_multicast_group(sock, *group)
+        return sock
+
+    def add_reader(self, fileobj, callback, daemon=False):
+        """Call callback(current_time) whenever fileobj is readable. The loop stops once
+        only daemon readers are left"""
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+        if daemon:
+            self.daemons.add(fileobj)
+
+    def add_datagram_reader(self, sock, on_datagram, on_drained=None, limit=DRAIN_LIMIT):
+        """Call on_datagram(data, current_time) for every datagram received on sock,
+        then on_drained(current_time) once the datagrams queued on it are handled.
+        data is a memoryview of a buffer the next datagram overwrites: copy what you keep"""
+        sock.setblocking(True)  # Sends may block, reads never do thanks to MSG_DONTWAIT
+        buffer = bytearray(self.RECEIVE_BUFFER)
+        view = memoryview(buffer)
+
+        def on_readable(current_time):
+            try:
+                for _ in range(limit):
+                    self.syscalls['recvfrom_into'] += 1
+                    size, addr = sock.recvfrom_into(buffer, 0, socket.MSG_DONTWAIT)
+                    self.guard(on_datagram, view[:size], current_time)
+                    if sock not in self.selector.get_map():
+                        return  # The role is done with this socket
+            except BlockingIOError:
+                pass
+            if on_drained:
+                on_drained(current_time)
+
+        self.add_reader(sock, on_readable)
+
+    def remove_reader(self, fileobj):
+        self.selector.unregister(fileobj)
+        self.daemons.discard(fileobj)
+
+    def send(self, sock, data, address):
+        """Queue a message for a group, it leaves with the others at the end of the iteration"""
+        self.outgoing.setdefault((sock, address), []).append(data)
+
+    def flush(self):
+        """Send the queued messages, consecutive ones for the same group packed into one
+        datagram up to COALESCE_BYTES; a larger message goes in a datagram of its own"""
+        outgoing, self.outgoing = self.outgoing, {}
+        for (sock, address), messages in outgoing.items():
+            datagram = []
+            size = 0
+            for data in messages:
+                if datagram and size + len(data) > self.COALESCE_BYTES:
+                    self.send_datagram(sock, b"".join(datagram), address)
+                    datagram = []
+                    size = 0
+                datagram.append(data)
+                size += len(data)
+            self.send_datagram(sock, b"".join(datagram), address)
+
+    def send_datagram(self, sock, data, address):
+        self.syscalls['sendto'] += 1
+        sock.sendto(data, address)
+
+    def call_at(self, when, callback):
+        """Call callback() at time when"""
+        timer = Timer(when, callback)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(self.time() + delay, callback)
+
+    def call_every(self, interval, callback):
+        timer = Timer(self.time() + interval, callback, interval)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def guard(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Error in %s", getattr(callback, '__qualname__', callback))
+
+    def stats(self):
+        return dict(self.metrics.snapshot(), syscalls=dict(self.syscalls))
+
+    def serve_stats(self, interval=0, port=None):
+        """Log the metrics every interval seconds, and answer every datagram sent to
+        127.0.0.1:port with them as JSON (either is off when not set)"""
+        if interval:
+            self.call_every(interval, lambda: logger.info("Stats: %s", self.metrics.report(self.time())))
+        if port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', port))
+            sock.setblocking(False)
+
+            def on_request(current_time):
+                try:
+                    _, address = sock.recvfrom(64)
+                except BlockingIOError:
+                    return
+                sock.sendto(json.dumps(self.stats()).encode(), address)
+
+            self.add_reader(sock, on_request, daemon=True)
+            logger.info("Serving stats on 127.0.0.1:%d", port)
+
+    def run(self):
+        while len(self.selector.get_map()) > len(self.daemons):
+            self.flush()
+            timeout = None
+            while self.timers and self.timers[0].cancelled:
+                heapq.heappop(self.timers)
+            if self.timers:
+                timeout = max(self.timers[0].when - self.time(), 0)
+            self.syscalls['select'] += 1
+            events = self.selector.select(timeout)
+            current_time = self.time()
+            for key, mask in events:
+                if key.fileobj in self.selector.get_map():  # Not removed by an earlier callback
+                    self.guard(key.data, current_time)
+
+            # Run the timers that are due, including ones the callbacks just set
+            while self.timers and self.timers[0].when <= self.time():
+                timer = heapq.heappop(self.timers)
+                if timer.cancelled:
+                    continue
+                if timer.interval is not None:
+                    timer.when = max(timer.when + timer.interval, self.time())
+                    heapq.heappush(self.timers, timer)
+                self.guard(timer.callback)
+        self.flush()  # Last words, e.g. SHUTDOWN
+        for fileobj in list(self.daemons):
+            self.remove_reader(fileobj)
+            fileobj.close()
+        logger.info("Event loop: %d syscalls: %s", sum(self.syscalls.values()),
+                    ", ".join(f"{count} {name}" for name, count in sorted(self.syscalls.items())))
+        logger.info("Stats: %s", self.metrics.report(self.time()))
+
+class RttEstimator:
+    """Retransmission timeout for one peer, from a smoothed mean and mean deviation
+    of measured round trips as in TCP (RFC 6298). Each timeout that expires doubles
+    the next one until a new sample arrives. Only sample exchanges that were not
+    retransmitted, an answer to a retransmission is ambiguous."""
+    __slots__ = ('srtt', 'rttvar', 'initial', 'minimum', 'maximum', 'backoff')
+
+    def __init__(self, initial, minimum, maximum):
+        self.srtt = None  # Smoothed round trip time, None until the first sample
+        self.rttvar = 0.0
+        self.initial = initial  # Timeout used before the first sample
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 1
+
+    def expired(self):
+        self.backoff = min(self.backoff * 2, 64)
+
+    def timeout(self):
+        rto = self.initial if self.srtt is None else max(self.srtt + 4 * self.rttvar, self.minimum)
+        return min(rto * self.backoff, self.maximum)
+
+
+def proposer(CONFIG, proposer_id, loop):
+    proposer_socket = loop.open_socket(CONFIG['proposers'])
+    learner_socket = loop.open_socket()  # Sends to learners and clients
+    metrics = loop.metrics
+
+    logger.info("Starting Proposer %d in group %d", proposer_id, CONFIG.get('group', 0))
+
     round_number = proposer_id
-    proposals = {}
-    regular_pending_values = deque(maxlen=10000)
+    highest_round_seen = 0
+    regular_pending_values = OrderedDict()  # Request -> None, oldest first
     end_message_queue = deque()
-    active_round = None
-    phase2_sent = False
-    phase1b_responses = set()  # Set to track unique acceptor responses
-    phase2b_responses = set()  # Set to track unique acceptor responses
-    decided_values = set()
-    current_value = None
-    
-    round_start_time = None
-    ROUND_TIMEOUT = 1.5
-    
+    decided_requests = RequestSet()
+    decided_ends = set()
+
+    # Consensus instances: every batch is decided in its own log slot
+    WINDOW = CONFIG.get('window', 16)  # Max instances in flight at once
+    in_flight = {}  # instance -> state of our proposal in that instance
+    proposals = {}  # instance -> {round: batch another proposer sent in its PHASE2A}, until decided
+    proposing = set()  # Requests and End entries currently assigned to an instance
+    next_instance = 1  # Lowest instance nobody has used yet
+    first_undecided = 1  # Every instance below this one is decided
+    decided_instances = set()
+    instance_activity = {}  # instance -> last time we saw another proposer work on it
+    COMMIT_HISTORY = 8
+    recent_commits = deque(maxlen=COMMIT_HISTORY)  # (instance, round) of our latest decisions
+
+    NOOP = ()  # Empty batch, fills an abandoned instance
+
+    # Round timeouts follow the measured round trips to the acceptors: a round
+    # times out once a majority of them should have answered
+    ROUND_TIMEOUT = 1.5  # Before any round trip was measured, and to spot abandoned instances
+    MIN_ROUND_TIMEOUT = 0.01
+    acceptor_rtt = {}  # acceptor id -> RttEstimator of its answers
+
+    # Congestion control: the instances in flight are limited to congestion_window,
+    # which grows by about one per window of instances decided without a retransmission
+    # and halves, at most once per round timeout, when a round times out
+    congestion_window = float(WINDOW)
+    last_window_cut = 0.0
+
+    # Batching: pending values are decided together in one instance, cut by size or age
+    BATCH_BYTES = min(CONFIG.get('batch_bytes', 60000),
+                      MAX_DATAGRAM - HEADER.size - REPORT.size)
+    BATCH_DELAY = CONFIG.get('batch_delay', 0.002)
+    pending_bytes = 0  # Size of regular_pending_values once encoded as a batch
+    first_pending_time = None  # When the oldest value in regular_pending_values arrived
+
+    # Stable leader (Multi-Paxos): the live proposer with the lowest id runs
+    # Phase 1 once for every instance from first_undecided on, then only sends PHASE2A
+    STABLE_LEADER = CONFIG.get('stable_leader', 1)
+    HEARTBEAT_INTERVAL = 0.2
+    LEADER_TIMEOUT = 1.0
+    SHUTDOWN_SENDS = 5
+    start_time = loop.time()
+
+    # Direct votes: learners also get our PHASE2A and the acceptors' PHASE2B and see a
+    # batch chosen one message delay before our DECISION, which then only needs the header
+    DIRECT_VOTES = CONFIG.get('direct_votes', 0)
+
+    # Fast Paxos: once prepared, the leader opens a fast round in which acceptors take
+    # values straight from the clients, and counts their votes. An instance is chosen
+    # once a fast quorum voted the same value; when acceptors disagree (a collision) or
+    # votes are overdue, a classic Phase 1 settles every open instance and reopens it.
+    FAST_PAXOS = CONFIG.get('fast_paxos', 0)
+    FAST_QUORUM = fast_quorum_size(CONFIG) if FAST_PAXOS else None
+    fast_from = None  # First instance of our fast round
+    fast_votes = {}  # instance -> {acceptor id: value it accepted in our fast round}
+    fast_seen = {}  # instance -> when we noticed it undecided in our fast round
+    fast_timer = None
+    last_forward_time = start_time
+    heartbeats = {}  # proposer id -> last time we heard its heartbeat
+    prepared = False  # Phase 1 done for our current round
+    preparing = None  # Outstanding Phase 1 for all instances
+
     client_value_counts = {}
-    values_decided = 0
     end_messages_received = set()
-    expected_clients = 2
-    
-    total_acceptors = 3  # Total number of acceptors in the system
-    ACCEPTOR_MAJORITY = (total_acceptors // 2) + 1
-    
-    while True:
-        try:
-            current_time = time.time()
-            
-            if active_round and round_start_time and (current_time - round_start_time > ROUND_TIMEOUT):
-                active_round = None
-                current_value = None
-                phase2_sent = False
-                phase1b_responses.clear()
-                phase2b_responses.clear()
-                round_start_time = None
-                current_backoff = min(current_backoff * 1.5, max_backoff)
-                time.sleep(0.001)
+    expected_clients = CONFIG.get('client_count', 2)
+
+    # Groups: learners merge the logs of the groups instance by instance, so the log
+    # of every group has to keep up with the others. Leaders tell each other their
+    # log tip on the pace address, and one that falls behind proposes what it has,
+    # or empty instances, without waiting for its batches to fill.
+    GROUPS = CONFIG.get('groups', 1)
+    GROUP = CONFIG.get('group', 0)
+    pace_socket = loop.open_socket(CONFIG['pace']) if GROUPS > 1 else None
+    pace_target = 0  # Highest log tip another group announced
+    pace_sent = 0  # Log tip we announced last
+
+    # Acceptor ids are 1..total_acceptors; Phase 1 and Phase 2 wait for quorums of their own size
+    total_acceptors, PHASE1_QUORUM, PHASE2_QUORUM = quorum_sizes(CONFIG)
+
+    def next_round():
+        nonlocal round_number
+        round_number += len(CONFIG['proposers'])
+        while round_number <= highest_round_seen:
+            round_number += len(CONFIG['proposers'])
+        return round_number
+
+    def saw_round(rnd):
+        nonlocal highest_round_seen, prepared
+        highest_round_seen = max(highest_round_seen, rnd)
+        if prepared and rnd > round_number:
+            # Another proposer ran Phase 1 with a higher round: we lost our promises
+            logger.info("Proposer %d: Preempted by round %d", proposer_id, rnd)
+            metrics.count('proposer.preemptions')
+            prepared = False
+
+    def is_leader(current_time):
+        if current_time - start_time < LEADER_TIMEOUT:
+            return False  # Listen for heartbeats before claiming leadership
+        return all(pid > proposer_id or current_time - last_seen > LEADER_TIMEOUT
+                   for pid, last_seen in heartbeats.items())
+
+    def rtt_of(acceptor_id):
+        estimator = acceptor_rtt.get(acceptor_id)
+        if estimator is None:
+            estimator = acceptor_rtt[acceptor_id] = RttEstimator(ROUND_TIMEOUT, MIN_ROUND_TIMEOUT, 2 * ROUND_TIMEOUT)
+        return estimator
+
+    def round_timeout(quorum=None):
+        """Time a quorum of the acceptors (Phase 2 by default) should need to answer"""
+        timeouts = sorted(rtt_of(acceptor_id).timeout() for acceptor_id in range(1, total_acceptors + 1))
+        return timeouts[(quorum or PHASE2_QUORUM) - 1]
+
+    def set_deadline(instance, state, deadline):
+        if state['timer']:
+            state['timer'].cancel()
+        state['deadline'] = deadline
+        state['timer'] = loop.call_at(deadline, lambda: on_round_timeout(instance, state))
+
+    def send_phase2a(instance, state):
+        state['phase2_sent'] = True
+        state['sent_at'] = loop.time()
+        state['attempts'] += 1
+        set_deadline(instance, state, state['sent_at'] + round_timeout())
+        if state['payload'] is None:
+            state['payload'] = encode_batch(state['value'])
+        phase2a_message = encode_message(PHASE2A, proposer_id, state['rnd'], instance, payload=state['payload'])
+        loop.send(proposer_socket, phase2a_message, CONFIG['acceptors'])
+        loop.send(proposer_socket, phase2a_message, CONFIG['proposers'])  # The other proposers learn the batch
+        if DIRECT_VOTES:
+            loop.send(learner_socket, phase2a_message, CONFIG['learners'])
+
+    def safe_value(reports):
+        """Batch to propose in an instance given the (accepted round, batch) reports of a
+        Phase 1 quorum: the one accepted in the highest round. Several batches can share
+        it only if it was a fast round, and then the one most acceptors reported is the
+        only one a fast quorum may have chosen."""
+        highest = max(accepted_rnd for accepted_rnd, _ in reports)
+        counts = Counter(value for accepted_rnd, value in reports if accepted_rnd == highest)
+        return counts.most_common(1)[0][0]
+
+    def new_instance_state(value, own_value, current_time):
+        return {
+            'rnd': round_number,
+            'value': value,  # Batch we will send in PHASE2A
+            'payload': None,  # The batch encoded, once we first send it
+            'own': own_value,  # Client values we want decided (None for recovery rounds)
+            'phase1b': set(),  # Unique acceptor responses
+            'phase2b': set(),  # Unique acceptor responses
+            'accepted_rnd': 0,  # Highest accepted round reported in PHASE1B
+            'accepted_val': None,
+            'phase2_sent': False,
+            'sent_at': None,  # Last time we sent PHASE2A
+            'attempts': 0,  # PHASE2A sends in this round, answers to the first one are RTT samples
+            'deadline': current_time + round_timeout(PHASE1_QUORUM),
+            'timer': None,  # Fires at the deadline
+            'started': current_time,  # For the commit latency
+        }
+
+    def start_round(instance, value, own_value, current_time):
+        if not STABLE_LEADER:
+            next_round()
+        state = in_flight[instance] = new_instance_state(value, own_value, current_time)
+        if STABLE_LEADER:
+            send_phase2a(instance, state)  # Phase 1 already covers this instance
+        else:
+            set_deadline(instance, state, state['deadline'])
+            phase1a_message = encode_message(PHASE1A, proposer_id, round_number, instance)
+            loop.send(proposer_socket, phase1a_message, CONFIG['acceptors'])
+
+    def start_prepare(current_time):
+        nonlocal preparing
+        preparing = {
+            'rnd': next_round(),
+            'from': first_undecided,
+            'phase1b': set(),  # Acceptors whose whole report arrived
+            'reports': {},  # acceptor id -> instances reported so far
+            'accepted': {},  # instance -> (accepted round, accepted batch) of every acceptor reporting it
+            'sent_at': current_time,
+            'deadline': current_time + round_timeout(PHASE1_QUORUM),
+        }
+        loop.call_at(preparing['deadline'], lambda attempt=preparing: on_prepare_timeout(attempt))
+        logger.info("Proposer %d: Running Phase 1 for instances >= %d in round %d", proposer_id, first_undecided, round_number)
+        metrics.count('proposer.phase1_rounds')
+        phase1a_message = encode_message(PHASE1A, proposer_id, round_number, first_undecided,
+                                         flags=FLAG_ALL_INSTANCES)
+        loop.send(proposer_socket, phase1a_message, CONFIG['acceptors'])
+
+    def finish_prepare():
+        nonlocal prepared, preparing, next_instance
+        metrics.observe('proposer.phase1', loop.time() - preparing['sent_at'])
+        accepted = preparing['accepted']
+        last_instance = max([next_instance - 1] + list(accepted))
+        for instance in range(preparing['from'], last_instance + 1):
+            if is_decided(instance):
                 continue
+            state = in_flight.get(instance)
+            if instance in accepted:
+                value = safe_value(accepted[instance])
+                if state and state['own'] is not None and state['own'] != value:
+                    requeue(state['own'])
+                    state['own'] = None
+            elif state:
+                value = state['value']
+            else:
+                value = NOOP  # Nobody can have chosen a value here
+            if not state:
+                state = in_flight[instance] = new_instance_state(value, None, loop.time())
+            state['rnd'] = round_number
+            if value != state['value']:
+                state['value'] = value
+                state['payload'] = None
+            state['phase2b'].clear()
+            send_phase2a(instance, state)
+        next_instance = max(next_instance, last_instance + 1)
+        prepared = True
+        preparing = None
+        if FAST_PAXOS:
+            open_fast_round()
 
-            msg = None
-            try:
-                msg, addr = proposer_socket.recvfrom(2**16)
-                msg = msg.decode()
-            except socket.timeout:
-                pass
+    def open_fast_round():
+        """Let acceptors take client values for every instance from next_instance on"""
+        nonlocal fast_from
+        fast_from = next_instance
+        fast_votes.clear()
+        fast_seen.clear()
+        logger.info("Proposer %d: Opening fast round %d for instances >= %d", proposer_id, round_number, fast_from)
+        send_fast_round()
 
-            if msg and msg.startswith("END_"):
-                parts = msg.split('_')
-                if len(parts) > 2:  # Format: END_clientId_valueCount
-                    client_id = int(parts[1])
-                    value_count = int(parts[2])
-                    client_value_counts[client_id] = value_count
-                if msg not in end_messages_received:
-                    end_messages_received.add(msg)
-                    end_message_queue.append(msg)
-                    print(f"Proposer {proposer_id}: Received END message: {msg}", file=sys.stderr)
-            
-            elif msg and msg.startswith("DECISION"):
-                _, value = msg.split()
-                if value not in decided_values:
-                    decided_values.add(value)
-                    if not value.startswith("END_"):
-                        values_decided += 1
-                    if value.startswith("END_"):
-                        if value in end_message_queue:
-                            end_message_queue.remove(value)
-                    else:
-                        if value in regular_pending_values:
-                            regular_pending_values.remove(value)
-                    print(f"Proposer {proposer_id}: Learned decided value {value} from another proposer", file=sys.stderr)
-
-            elif msg and not msg.startswith("PHASE"):
-                value = msg.strip()
-                if value not in decided_values and value not in regular_pending_values:
-                    regular_pending_values.append(value)
-                    print(f"Proposer {proposer_id}: Received new value: {value}", file=sys.stderr)
-                    
-
-            if not active_round and regular_pending_values and not current_value:
-                current_value = regular_pending_values[0]
-                round_number += len(CONFIG['proposers'])
-                active_round = round_number
-                proposals[round_number] = current_value
-                phase1b_responses.clear()
-                phase2b_responses.clear()
-                phase2_sent = False
-                round_start_time = current_time
-                
-                print(f"Proposer {proposer_id}: Proposing value {current_value} in round {round_number}", file=sys.stderr)
-                
-                phase1a_message = f"PHASE1A {round_number}"
-                proposer_socket.sendto(phase1a_message.encode(), CONFIG['acceptors'])
-
-            elif not active_round and not regular_pending_values and end_message_queue and not current_value:
-                current_value = end_message_queue[0]
-                round_number += len(CONFIG['proposers'])
-                active_round = round_number
-                proposals[round_number] = current_value
-                phase1b_responses.clear()
-                phase2b_responses.clear()
-                phase2_sent = False
-                round_start_time = current_time
-                
-                print(f"Proposer {proposer_id}: Proposing END message {current_value} in round {round_number}", file=sys.stderr)
-                
-                phase1a_message = f"PHASE1A {round_number}"
-                proposer_socket.sendto(phase1a_message.encode(), CONFIG['acceptors'])
-
-            if msg and msg.startswith("PHASE1B"):
-                parts = msg.split()
-                if len(parts) >= 3:  # Must include round and acceptor_id at minimum
-                    rnd = int(parts[1])
-                    acceptor_id = parts[2]
-                    if rnd == active_round and not phase2_sent:
-                        phase1b_responses.add(acceptor_id)  # Track unique acceptor responses
-                        
-                        print(f"Proposer {proposer_id}: Received PHASE1B from acceptor {acceptor_id} for round {rnd}. Count: {len(phase1b_responses)}", file=sys.stderr)
-                        
-                        if len(phase1b_responses) >= ACCEPTOR_MAJORITY:
-                            print(f"Proposer {proposer_id}: Sending PHASE2A for round {rnd} with value {proposals[rnd]}", file=sys.stderr)
-                            
-                            phase2a_message = f"PHASE2A {rnd} {proposals[rnd]}"
-                            proposer_socket.sendto(phase2a_message.encode(), CONFIG['acceptors'])
-                            phase2_sent = True
-                            current_backoff = min_backoff
-
-            elif msg and msg.startswith("PHASE2B"):
-                parts = msg.split()
-                if len(parts) >= 4:  # Must include round, value, and acceptor_id
-                    rnd = int(parts[1])
-                    val = parts[2]
-                    acceptor_id = parts[3]
-                    if rnd == active_round and val == proposals[rnd]:
-                        phase2b_responses.add(acceptor_id)  # Track unique acceptor responses
-                        
-                        print(f"Proposer {proposer_id}: Received PHASE2B from acceptor {acceptor_id} for round {rnd}. Count: {len(phase2b_responses)}", file=sys.stderr)
-                        
-                        if len(phase2b_responses) >= ACCEPTOR_MAJORITY:
-                            decided_value = proposals[active_round]
-                            decided_values.add(decided_value)
-                            if not decided_value.startswith("END_"):
-                                values_decided += 1
-                            
-                            print(f"Proposer {proposer_id}: Decided value {decided_value}", file=sys.stderr)
-                            
-                            decision_message = f"DECISION {decided_value}"
-                            learner_socket.sendto(decision_message.encode(), CONFIG['learners'])
-                            proposer_socket.sendto(decision_message.encode(), CONFIG['proposers'])
-                            
-                            if decided_value.startswith("END_"):
-                                if decided_value in end_message_queue:
-                                    end_message_queue.remove(decided_value)
-                            else:
-                                if decided_value in regular_pending_values:
-                                    regular_pending_values.remove(decided_value)
-                            
-                            current_value = None
-                            active_round = None
-                            phase2_sent = False
-                            phase1b_responses.clear()
-                            phase2b_responses.clear()
-                            current_backoff = min_backoff
-
-            total_expected_values = sum(client_value_counts.values())
-            if (not active_round and 
-                not regular_pending_values and 
-                not end_message_queue and 
-                len(end_messages_received) >= expected_clients and
-                total_expected_values > 0 and
-                values_decided >= total_expected_values):
-                
-                end_message = f"END_{proposer_id}_{values_decided}"
-                proposer_socket.sendto(end_message.encode(), CONFIG['acceptors'])
-                proposer_socket.sendto(end_message.encode(), CONFIG['learners'])
-                print(f"Proposer {proposer_id}: Sent {end_message}, terminating. Processed {values_decided}/{total_expected_values} values", file=sys.stderr)
-                break
+    def send_fast_round():
+        any_message = encode_message(PHASE2A, proposer_id, round_number, fast_from, flags=FLAG_ANY)
+        loop.send(proposer_socket, any_message, CONFIG['acceptors'])
+
+    def recover_fast_round(current_time, reason):
+        """Settle the open instances of the fast round with a classic Phase 1 in a higher round"""
+        nonlocal prepared
+        logger.info("Proposer %d: %s, recovering with a classic round", proposer_id, reason)
+        metrics.count('proposer.fast_recoveries')
+        prepared = False
+        fast_votes.clear()
+        fast_seen.clear()
+        start_prepare(current_time)
+
+    def step_down():
+        nonlocal prepared, preparing
+        prepared = False
+        preparing = None
+        for state in in_flight.values():
+            if state['own'] is not None:
+                requeue(state['own'])
+        in_flight.clear()
+
+    def add_pending(request, current_time, front=False):
+        nonlocal pending_bytes, first_pending_time
+        regular_pending_values[request] = None
+        if front:
+            regular_pending_values.move_to_end(request, last=False)
+        pending_bytes += entry_size(request)
+        if first_pending_time is None:
+            first_pending_time = current_time
+
+    def remove_pending(request):
+        nonlocal pending_bytes, first_pending_time
+        del regular_pending_values[request]
+        pending_bytes -= entry_size(request)
+        if not regular_pending_values:
+            first_pending_time = None
+
+    def is_entry_decided(entry):
+        if entry.__class__ is End:
+            return entry in decided_ends
+        return entry in decided_requests
+
+    def next_batch(current_time, hurry=False):
+        """Cut a batch off the pending values once it is full or its oldest value waited
+        BATCH_DELAY, or right away if we hurry"""
+        nonlocal pending_bytes, first_pending_time
+        full = pending_bytes >= BATCH_BYTES
+        if not full and not hurry and current_time < first_pending_time + BATCH_DELAY:
+            return None
+        batch = []
+        batch_bytes = 0
+        while regular_pending_values and (not batch or batch_bytes + entry_size(next(iter(regular_pending_values))) <= BATCH_BYTES):
+            request = regular_pending_values.popitem(last=False)[0]
+            pending_bytes -= entry_size(request)
+            if request in decided_requests or request in proposing:
+                continue
+            batch.append(request)
+            batch_bytes += entry_size(request)
+        if not regular_pending_values:
+            first_pending_time = None
+        if batch:
+            metrics.count('proposer.batch_count')
+            metrics.count('proposer.batch_full' if full else 'proposer.batch_timed_out')
+            metrics.count('proposer.batch_values', len(batch))
+            metrics.count('proposer.batch_bytes', batch_bytes)
+        return batch
+
+    def release(batch):
+        for value in batch:
+            proposing.discard(value)
+
+    def requeue(batch):
+        for value in reversed(batch):
+            proposing.discard(value)
+            if is_entry_decided(value) or value in regular_pending_values:
+                continue
+            if isinstance(value, End):
+                end_message_queue.appendleft(value)
+            else:
+                add_pending(value, 0, front=True)  # Requeued values are due right away
+
+    def record_decision(instance, batch):
+        nonlocal first_undecided
+        metrics.count('proposer.decisions')
+        metrics.count('proposer.values_decided', len(batch))
+        decided_instances.add(instance)
+        instance_activity.pop(instance, None)
+        proposals.pop(instance, None)
+        while first_undecided in decided_instances:
+            decided_instances.discard(first_undecided)
+            first_undecided += 1
+        fast_votes.pop(instance, None)
+        fast_seen.pop(instance, None)
+        for value in batch:
+            if isinstance(value, End):
+                # With fast_paxos clients send their END to the acceptors only
+                end_messages_received.add(value)
+                client_value_counts[value.client_id] = value.count
+                if value not in decided_ends:
+                    decided_ends.add(value)
+                    if value in end_message_queue:
+                        end_message_queue.remove(value)
+            elif decided_requests.add(value):
+                if value in regular_pending_values:
+                    remove_pending(value)
+
+    def is_decided(instance):
+        return instance < first_undecided or instance in decided_instances
+
+    def saw_instance(instance, current_time):
+        nonlocal next_instance
+        next_instance = max(next_instance, instance + 1)
+        if instance not in in_flight and not is_decided(instance):
+            instance_activity[instance] = current_time
+
+    def acknowledge(entry):
+        """Tell a client that retransmitted an entry that it is already decided"""
+        if prepared or not STABLE_LEADER:
+            ack_message = encode_message(CLIENT_ACK, proposer_id, payload=encode_batch([entry]))
+            loop.send(learner_socket, ack_message, CONFIG['client'])
+
+    def on_client_end(msg, current_time):
+        end = End(msg.sender, msg.aux)
+        if end in decided_ends:
+            acknowledge(end)
+        client_value_counts[end.client_id] = end.count
+        if end not in end_messages_received:
+            end_messages_received.add(end)
+            end_message_queue.append(end)
+            logger.info("Proposer %d: Received END message: client %d, %d values", proposer_id, end.client_id, end.count)
+
+    def on_decision(msg, current_time):
+        instance = msg.instance
+        saw_instance(instance, current_time)
+        if not is_decided(instance):
+            state = in_flight.pop(instance, None)
+            # Only fast round decisions carry the batch, in classic rounds we have it from the PHASE2A
+            batch_payload = msg.payload or proposals.get(instance, {}).get(msg.ballot)
+            if batch_payload is None and state and state['rnd'] == msg.ballot:
+                batch_payload = state['payload']
+            # Without the PHASE2A we do not know what was decided: our own values are
+            # proposed again, and learners drop any that the lost batch held
+            value = decode_batch(batch_payload) if batch_payload is not None else ()
+            if state and state['own'] is not None:
+                release(state['own'])
+                if state['own'] != value:
+                    requeue(state['own'])
+            record_decision(instance, value)
+            logger.debug("Proposer %d: Learned decided batch of %d values in instance %d from another proposer",
+                         proposer_id, len(value), instance)
+
+    def on_phase2a(msg, current_time):
+        if msg.sender != proposer_id and not is_decided(msg.instance):
+            proposals.setdefault(msg.instance, {})[msg.ballot] = msg.payload
+
+    def on_snapshot(msg, current_time):
+        """An acceptor truncated its log below msg.instance: every instance before it
+        is decided, and the snapshot tells which requests and END entries they hold"""
+        nonlocal first_undecided, next_instance
+        base = msg.instance
+        if base <= first_undecided:
+            return
+        requests, ends = decode_snapshot(msg.payload)
+        decided_requests.update(requests)
+        for end in ends:
+            decided_ends.add(end)
+            end_messages_received.add(end)
+            client_value_counts[end.client_id] = end.count
+            if end in end_message_queue:
+                end_message_queue.remove(end)
+        for request in [request for request in regular_pending_values if request in decided_requests]:
+            remove_pending(request)
+        for instance in [instance for instance in in_flight if instance < base]:
+            state = in_flight.pop(instance)
+            if state['own'] is not None:
+                requeue(state['own'])  # Drops what the snapshot says is decided
+        for instance in [instance for instance in instance_activity if instance < base]:
+            del instance_activity[instance]
+        for instance in [instance for instance in proposals if instance < base]:
+            del proposals[instance]
+        decided_instances.difference_update([instance for instance in decided_instances if instance < base])
+        first_undecided = base
+        while first_undecided in decided_instances:
+            decided_instances.discard(first_undecided)
+            first_undecided += 1
+        next_instance = max(next_instance, first_undecided)
+        logger.info("Proposer %d: Installed snapshot from acceptor %d, instances below %d are decided", proposer_id, msg.sender, base)
+        if preparing and preparing['from'] < base:
+            start_prepare(current_time)  # Acceptors that truncated did not answer our Phase 1
+
+    def on_shutdown(msg, current_time):
+        # Another proposer saw every value decided
+        logger.info("Proposer %d: Received SHUTDOWN from proposer %d, terminating", proposer_id, msg.sender)
+        stop()
+        loop.remove_reader(proposer_socket)
+
+    def on_heartbeat(msg, current_time):
+        if msg.sender != proposer_id:
+            heartbeats[msg.sender] = current_time
+            saw_round(msg.ballot)
+
+    def on_client_value(msg, current_time):
+        request = Request(msg.sender, msg.aux, msg.payload.decode())
+        if "\n" in request.value:
+            return  # Values are single lines
+        if request in decided_requests:
+            acknowledge(request)
+        elif FAST_PAXOS:
+            pass  # Acceptors take the values, we only acknowledge retransmissions of decided ones
+        elif request not in proposing and request not in regular_pending_values:
+            add_pending(request, current_time)
+            logger.debug("Proposer %d: Received new value: %s (client %d, seq %d)",
+                         proposer_id, request.value, request.client_id, request.seq)
+
+    def on_phase1b(msg, current_time):
+        rnd = msg.ballot
+        instance = msg.instance
+        acceptor_id = msg.sender
+        report_count = msg.aux
+        # Reports of accepted instances, possibly spread over several
+        # datagrams when the accepted batches are large
+        reported = [(inst, accepted_rnd, decode_batch(batch))
+                    for inst, accepted_rnd, batch in decode_reports(msg.payload)]
+        saw_round(rnd)
+
+        if preparing and rnd == preparing['rnd']:
+            if acceptor_id not in preparing['reports']:
+                rtt_of(acceptor_id).sample(current_time - preparing['sent_at'])  # Every attempt has its own round
+            received = preparing['reports'].setdefault(acceptor_id, set())
+            for inst, accepted_rnd, accepted_val in reported:
+                if inst not in received:
+                    received.add(inst)
+                    preparing['accepted'].setdefault(inst, []).append((accepted_rnd, accepted_val))
+            if len(received) >= report_count:
+                preparing['phase1b'].add(acceptor_id)
+
+            logger.debug("Proposer %d: Received PHASE1B from acceptor %d for instances >= %d round %d. Count: %d",
+                         proposer_id, acceptor_id, instance, rnd, len(preparing['phase1b']))
+
+            if len(preparing['phase1b']) >= PHASE1_QUORUM:
+                finish_prepare()
+        elif not STABLE_LEADER:
+            saw_instance(instance, current_time)
+            state = in_flight.get(instance)
+            if state and rnd == state['rnd'] and not state['phase2_sent']:
+                state['phase1b'].add(acceptor_id)  # Track unique acceptor responses
+                for inst, accepted_rnd, accepted_val in reported:
+                    if inst == instance and accepted_rnd > state['accepted_rnd']:
+                        state['accepted_rnd'] = accepted_rnd
+                        state['accepted_val'] = accepted_val
+
+                logger.debug("Proposer %d: Received PHASE1B from acceptor %d for instance %d round %d. Count: %d",
+                             proposer_id, acceptor_id, instance, rnd, len(state['phase1b']))
+
+                if len(state['phase1b']) >= PHASE1_QUORUM:
+                    if state['accepted_val'] is not None and state['accepted_val'] != state['value']:
+                        # An acceptor may already have accepted a value here: we must propose it
+                        if state['own'] is not None:
+                            requeue(state['own'])
+                            state['own'] = None
+                        state['value'] = state['accepted_val']
+                        state['payload'] = None
+
+                    logger.debug("Proposer %d: Sending PHASE2A for instance %d round %d with %d values",
+                                 proposer_id, instance, rnd, len(state['value']))
+                    send_phase2a(instance, state)
+
+    def send_decision(instance, rnd, batch_payload, classic=True):
+        decision_message = encode_message(DECISION, proposer_id, rnd, instance, payload=batch_payload)
+        summary_message = decision_message
+        if classic:
+            # The proposers, and with direct votes the learners, have the batch from
+            # our PHASE2A: their DECISION is only a header
+            summary_message = encode_message(DECISION, proposer_id, rnd, instance)
+        loop.send(learner_socket, summary_message if DIRECT_VOTES else decision_message, CONFIG['learners'])
+        loop.send(proposer_socket, summary_message, CONFIG['proposers'])
+        client_message = encode_message(DECISION, proposer_id, rnd, instance, payload=batch_ids(batch_payload))
+        loop.send(learner_socket, client_message, CONFIG['client'])  # Clients learn their requests are done
+        # Tell acceptors their accepted batch is chosen so they can serve it to lagging learners.
+        # The checksum tells them apart from acceptors that voted for another value in a fast round
+        recent_commits.append((instance, rnd, zlib.crc32(batch_payload)))
+        send_commits()
+
+    def on_fast_vote(msg, current_time):
+        """PHASE2B of our fast round, carrying the value the acceptor accepted"""
+        nonlocal fast_timer
+        instance = msg.instance
+        if not prepared or msg.ballot != round_number or is_decided(instance) or instance in in_flight:
+            return
+        votes = fast_votes.setdefault(instance, {})
+        votes[msg.sender] = msg.payload
+        value, count = Counter(votes.values()).most_common(1)[0]
+        if count >= FAST_QUORUM:
+            batch = decode_batch(value)
+            record_decision(instance, batch)
+            logger.debug("Proposer %d: Decided batch of %d values in instance %d in fast round %d",
+                         proposer_id, len(batch), instance, msg.ballot)
+            send_decision(instance, msg.ballot, value, classic=False)
+            return
+        if count + total_acceptors - len(votes) < FAST_QUORUM:
+            recover_fast_round(current_time, f"Collision in instance {instance}")
+            return
+        # This instance, and any below it whose votes all got lost, must be settled within a round timeout
+        for hole in range(max(first_undecided, fast_from), instance + 1):
+            if not is_decided(hole) and hole not in in_flight:
+                fast_seen.setdefault(hole, current_time)
+        if fast_timer is None:
+            fast_timer = loop.call_at(min(fast_seen.values()) + round_timeout(), check_fast_round)
+
+    def check_fast_round():
+        nonlocal fast_timer
+        fast_timer = None
+        if finished or not prepared or not fast_seen:
+            return
+        current_time = loop.time()
+        oldest = min(fast_seen.values())
+        if current_time >= oldest + round_timeout():
+            recover_fast_round(current_time, "Fast round votes overdue")
+        else:
+            fast_timer = loop.call_at(oldest + round_timeout(), check_fast_round)
+
+    def on_phase2b(msg, current_time):
+        nonlocal congestion_window
+        rnd = msg.ballot
+        instance = msg.instance
+        acceptor_id = msg.sender
+        saw_round(rnd)
+        saw_instance(instance, current_time)
+        if msg.payload:
+            on_fast_vote(msg, current_time)
+            return
+        state = in_flight.get(instance)
+        if state and rnd == state['rnd']:  # One value per round and instance
+            if state['attempts'] == 1 and acceptor_id not in state['phase2b']:
+                rtt_of(acceptor_id).sample(current_time - state['sent_at'])
+            state['phase2b'].add(acceptor_id)  # Track unique acceptor responses
+
+            logger.debug("Proposer %d: Received PHASE2B from acceptor %d for instance %d round %d. Count: %d",
+                         proposer_id, acceptor_id, instance, rnd, len(state['phase2b']))
+
+            if len(state['phase2b']) >= PHASE2_QUORUM:
+                decided_value = state['value']
+                del in_flight[instance]
+                if state['own'] is not None:
+                    release(state['own'])
+                record_decision(instance, decided_value)
+                metrics.observe('proposer.commit', current_time - state['started'])
+
+                logger.debug("Proposer %d: Decided batch of %d values in instance %d", proposer_id, len(decided_value), instance)
 
-        except socket.timeout:
-            if active_round:
-                if active_round in proposals:
-                    value = proposals[active_round]
-                    if value not in decided_values:
-                        time.sleep(current_backoff)
-                        current_backoff = min(current_backoff * 1.5, max_backoff)
-                        print(f"Proposer {proposer_id}: Timeout in round {active_round}. Backoff: {current_backoff}", file=sys.stderr)
-                active_round = None
-                phase2_sent = False
-                phase1b_responses.clear()
-                phase2b_responses.clear()
-                current_value = None
-            continue
-
-        except Exception as e:
-            print(f"Proposer {proposer_id} error: {str(e)}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
-
-def acceptor(CONFIG, id):
-    acceptor_socket = create_multicast_socket()
-    acceptor_addr, acceptor_port = CONFIG['acceptors']
-    join_multicast_group(acceptor_socket, acceptor_addr, acceptor_port)
-    
-    print(f"Starting Acceptor {id}", file=sys.stderr)
-    
-    promised_rnd = 0
-    accepted_rnd = 0
-    accepted_val = None
-    last_message_time = time.time()
-    MIN_MESSAGE_INTERVAL = 0.0005
-
-    while True:
+                send_decision(instance, rnd, state['payload'])
+
+                if state['attempts'] == 1:
+                    congestion_window = min(congestion_window + 1 / congestion_window, WINDOW)
+
+    handlers = {
+        CLIENT_VALUE: on_client_value,
+        CLIENT_END: on_client_end,
+        DECISION: on_decision,
+        HEARTBEAT: on_heartbeat,
+        PHASE1B: on_phase1b,
+        PHASE2A: on_phase2a,
+        PHASE2B: on_phase2b,
+        SNAPSHOT: on_snapshot,
+        SHUTDOWN: on_shutdown,
+    }
+
+    def on_datagram(data, current_time):
+        for msg in decode_messages(data):
+            if finished:
+                return
+            handler = handlers.get(msg.type)
+            if handler:
+                handler(msg, current_time)
+
+    def on_pace(data, current_time):
+        nonlocal pace_target
+        for msg in decode_messages(data):
+            if msg.type == PACE and msg.sender != GROUP:
+                pace_target = max(pace_target, msg.instance)
+        progress(current_time)
+
+    def send_pace():
+        nonlocal pace_sent
+        pace_sent = next_instance
+        pace_message = encode_message(PACE, GROUP, round_number, next_instance)
+        loop.send(pace_socket, pace_message, CONFIG['pace'])
+
+    def send_commits():
+        commit_message = encode_message(COMMIT, proposer_id,
+                                        payload=b"".join([COMMIT_ENTRY.pack(*entry) for entry in recent_commits]))
+        loop.send(proposer_socket, commit_message, CONFIG['acceptors'])
+
+    def tick():
+        """Heartbeats, leader election and forwarding to the leader"""
+        nonlocal last_forward_time
+        current_time = loop.time()
+        # Every instance below first_undecided is decided: learners use it to spot gaps
+        heartbeat_message = encode_message(HEARTBEAT, proposer_id, round_number, first_undecided)
+        loop.send(proposer_socket, heartbeat_message, CONFIG['proposers'])
+        if prepared:
+            loop.send(learner_socket, heartbeat_message, CONFIG['learners'])
+            if recent_commits:
+                send_commits()  # The latest decisions have no later COMMIT to repeat them
+            if FAST_PAXOS:
+                send_fast_round()  # Acceptors that missed it hold client values back
+            if GROUPS > 1:
+                send_pace()
+
+        if is_leader(current_time):
+            if not prepared and not preparing:
+                start_prepare(current_time)
+        else:
+            if prepared or preparing or in_flight:
+                logger.info("Proposer %d: Stepping down, a lower id proposer is alive", proposer_id)
+                step_down()
+            # Make sure the leader knows about values it may have missed
+            if current_time - last_forward_time > LEADER_TIMEOUT:
+                for request in islice(regular_pending_values, WINDOW):
+                    forward_message = encode_message(CLIENT_VALUE, request.client_id, aux=request.seq,
+                                                     payload=request.value.encode())
+                    loop.send(proposer_socket, forward_message, CONFIG['proposers'])
+                last_forward_time = current_time
+        progress(current_time)
+
+    def on_prepare_timeout(attempt):
+        if preparing is attempt and is_leader(loop.time()):
+            metrics.count('proposer.phase1_timeouts')
+            for acceptor_id in range(1, total_acceptors + 1):
+                if acceptor_id not in attempt['phase1b']:
+                    rtt_of(acceptor_id).expired()
+            start_prepare(loop.time())
+
+    def on_round_timeout(instance, state):
+        """Retry our instance whose round did not finish in time"""
+        nonlocal congestion_window, last_window_cut
+        if finished or in_flight.get(instance) is not state:
+            return  # Decided or given up in the meantime
+        current_time = loop.time()
+        if current_time - last_window_cut > round_timeout():
+            # One loss event per round timeout: the instances in flight time out together
+            answered = state['phase2b'] if state['phase2_sent'] else state['phase1b']
+            for acceptor_id in range(1, total_acceptors + 1):
+                if acceptor_id not in answered:
+                    rtt_of(acceptor_id).expired()
+            congestion_window = max(congestion_window / 2, 1.0)
+            last_window_cut = current_time
+        logger.debug("Proposer %d: Timeout in instance %d round %d. Next timeout %.3f s, window %d",
+                     proposer_id, instance, state['rnd'], round_timeout(), congestion_window)
+        metrics.count('proposer.round_timeouts')
+        if STABLE_LEADER:
+            if prepared:
+                send_phase2a(instance, state)
+            else:
+                set_deadline(instance, state, current_time + round_timeout())
+        else:
+            own_value = state['own']
+            start_round(instance, own_value if own_value is not None else NOOP, own_value, current_time)
+
+    def recover_abandoned():
+        """Take over instances another proposer started but never finished
+        (in stable leader mode the leader's Phase 1 covers them)"""
+        if finished:
+            return
+        current_time = loop.time()
+        next_check = current_time + 2 * ROUND_TIMEOUT
+        for instance in range(first_undecided, next_instance):
+            if instance in in_flight or instance in decided_instances:
+                continue
+            last_seen = instance_activity.setdefault(instance, current_time)
+            if current_time - last_seen >= 2 * ROUND_TIMEOUT:
+                logger.info("Proposer %d: Recovering abandoned instance %d", proposer_id, instance)
+                start_round(instance, NOOP, None, current_time)
+            else:
+                next_check = min(next_check, last_seen + 2 * ROUND_TIMEOUT)
+        loop.call_at(next_check, recover_abandoned)
+
+    def on_batch_due():
+        nonlocal batch_timer
+        batch_timer = None
+        progress(loop.time())
+
+    def fill_window(current_time):
+        """Start new instances while the window has room"""
+        nonlocal next_instance, batch_timer
+        # Another group's log is ahead: fill ours up to its tip, unless all our values are decided
+        behind = next_instance < pace_target and not all_values_decided()
+        # In a fast round the acceptors take the values from the clients and own every new instance
+        while (len(in_flight) < int(congestion_window) and (regular_pending_values or end_message_queue or behind) and
+               (prepared or not STABLE_LEADER) and not FAST_PAXOS):
+            if regular_pending_values:
+                batch = next_batch(current_time, hurry=behind)
+                if batch is None:
+                    # Let the batch fill up, and come back when it is due
+                    if batch_timer is None:
+                        batch_timer = loop.call_at(first_pending_time + BATCH_DELAY, on_batch_due)
+                    break
+            elif end_message_queue and not in_flight:
+                batch = [end_message_queue.popleft()]
+            elif behind:
+                batch = NOOP
+            else:
+                break  # END messages go out once regular values are done
+            batch = tuple(value for value in batch if not is_entry_decided(value) and value not in proposing)
+            if not batch and not behind:
+                continue
+            proposing.update(batch)
+            instance = next_instance
+            next_instance += 1
+            start_round(instance, batch, batch, current_time)
+
+            logger.debug("Proposer %d: Proposing %d values in instance %d round %d",
+                         proposer_id, len(batch), instance, in_flight[instance]['rnd'])
+            behind = next_instance < pace_target
+
+    def all_values_decided():
+        return (len(end_messages_received) >= expected_clients and
+                len(decided_requests) >= sum(client_value_counts.values()))
+
+    def progress(current_time):
+        if finished:
+            return
+        fill_window(current_time)
+        if GROUPS > 1 and prepared and next_instance > pace_sent:
+            send_pace()
+
+        total_expected_values = sum(client_value_counts.values())
+        if (not in_flight and
+            not regular_pending_values and
+            not end_message_queue and
+            first_undecided >= next_instance and
+            all_values_decided()):
+
+            logger.info("Proposer %d: Sending SHUTDOWN, terminating. Processed %d/%d values",
+                        proposer_id, len(decided_requests), total_expected_values)
+            stop()
+            send_shutdown(SHUTDOWN_SENDS)
+
+    def send_shutdown(remaining):
+        """SHUTDOWN goes out a few times, a single lost copy would leave a role waiting forever"""
+        end_message = encode_message(SHUTDOWN, proposer_id, instance=first_undecided, aux=len(decided_requests))
+        loop.send(proposer_socket, end_message, CONFIG['acceptors'])
+        loop.send(proposer_socket, end_message, CONFIG['learners'])
+        loop.send(proposer_socket, end_message, CONFIG['proposers'])
+        if recent_commits:
+            send_commits()
+        if remaining > 1:
+            loop.call_later(HEARTBEAT_INTERVAL, lambda: send_shutdown(remaining - 1))
+        else:
+            loop.remove_reader(proposer_socket)
+
+    def stop():
+        nonlocal finished
+        finished = True
+        for timer in periodic_timers:
+            timer.cancel()
+        if pace_socket:
+            loop.remove_reader(pace_socket)
+
+    finished = False
+    batch_timer = None
+    metrics.gauge('proposer.pending', lambda: len(regular_pending_values))
+    metrics.gauge('proposer.in_flight', lambda: len(in_flight))
+    metrics.gauge('proposer.window', lambda: int(congestion_window))
+    loop.add_datagram_reader(proposer_socket, on_datagram, on_drained=progress)
+    if pace_socket:
+        loop.add_datagram_reader(pace_socket, on_pace)
+    periodic_timers = []
+    if STABLE_LEADER:
+        periodic_timers.append(loop.call_every(HEARTBEAT_INTERVAL, tick))
+    else:
+        loop.call_later(2 * ROUND_TIMEOUT, recover_abandoned)
+
+# Durable acceptor state (enabled with the wal_dir setting)
+#
+# log.<gen>    append-only records: instance promises, stable-leader promises,
+#              accepts; a generation starts with the snapshot of the instances
+#              below its base instance
+# index.<gen>  memory-mapped array, one slot per instance from the base on:
+#              promised round, accepted round, offset of the ACCEPT record
+#              holding the value in the log
+# checkpoint   current generation, leader promise and the log offset up to
+#              which the index is on disk; recovery only replays the log after it
+WAL_PROMISE = 1
+WAL_LEADER = 2  # instance is the first instance covered by the promise
+WAL_ACCEPT = 3
+WAL_SNAPSHOT = 4  # instance is the base of the generation, the value the snapshot
+
+WAL_RECORD = struct.Struct("!IBQQI")  # crc32, kind, instance, round, value length
+INDEX_SLOT = struct.Struct("!QQQ")  # promised round, accepted round, record offset
+# leader round, leader from, log offset, generation, base instance, crc32
+CHECKPOINT = struct.Struct("!QQQQQI")
+
+class AcceptorLog:
+    CHECKPOINT_RECORDS = 20000  # Checkpoint after this many records
+    INITIAL_SLOTS = 4096
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.log = None
+        self.index_file = None
+        self.index = None
+        self.slots = 0
+        self.pending = []  # Records appended since the last sync
+        self.dirty_slots = {}  # instance -> slot, written to the index once the log is synced
+        self.pending_values = {}  # instance -> value accepted since the last sync
+        self.records_since_checkpoint = 0
+        self.leader_rnd = 0
+        self.leader_from = 0
+        self.generation = 0
+        self.base = 0  # Instances below the base only exist in the snapshot
+        self.snapshot = None
+        self.log_end = 0
+        self._recover()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open_generation(self, generation, base, fresh=False):
+        if self.index is not None:
+            self.index.close()
+            self.index_file.close()
+            self.log.close()
+        self.generation = generation
+        self.base = base
+        self.log = open(self._path(f"log.{generation}"), "a+b")
+        self.index_file = open(self._path(f"index.{generation}"), "a+b")
+        if fresh:
+            self.log.truncate(0)
+            self.index_file.truncate(0)
+        self.index = None
+        size = os.fstat(self.index_file.fileno()).st_size
+        self._map_index(max(size // INDEX_SLOT.size, self.INITIAL_SLOTS))
+
+    def _map_index(self, slots):
+        if self.index is not None:
+            self.index.close()
+        size = max(slots, 1) * INDEX_SLOT.size
+        if os.fstat(self.index_file.fileno()).st_size < size:
+            self.index_file.truncate(size)
+        self.index = mmap.mmap(self.index_file.fileno(), size)
+        self.slots = slots
+
+    def _slot(self, instance):
+        position = instance - self.base
+        if position >= self.slots:
+            slots = self.slots
+            while position >= slots:
+                slots *= 2
+            self.index.flush()
+            self._map_index(slots)
+        return INDEX_SLOT.unpack_from(self.index, position * INDEX_SLOT.size)
+
+    def _set_slot(self, instance, slot):
+        self._slot(instance)  # Grow the index if needed
+        INDEX_SLOT.pack_into(self.index, (instance - self.base) * INDEX_SLOT.size, *slot)
+
+    def _read_checkpoint(self):
         try:
-            msg, addr = acceptor_socket.recvfrom(2**16)
-            msg = msg.decode().strip()
-            
-            current_time = time.time()
-            time_since_last = current_time - last_message_time
-            if time_since_last < MIN_MESSAGE_INTERVAL:
-                time.sleep(MIN_MESSAGE_INTERVAL - time_since_last)
-            last_message_time = current_time
-            
-            print(f"Acceptor {id} received: {msg}", file=sys.stderr)
-
-            if msg.startswith("PHASE1A"):
-                _, rnd = msg.split()
-                rnd = int(rnd)
-                
-                if rnd >= promised_rnd:
-                    promised_rnd = rnd
-                    response = f"PHASE1B {rnd} {id}"  # Include acceptor ID
-                    if accepted_rnd > 0:
-                        response = f"{response} {accepted_rnd} {accepted_val}"
-                    acceptor_socket.sendto(response.encode(), CONFIG['proposers'])
-
-            elif msg.startswith("PHASE2A"):
-                
-                _, rnd, value = msg.split()
-                rnd = int(rnd)
-                
-                if rnd >= promised_rnd:
-                    promised_rnd = rnd
-                    accepted_rnd = rnd
-                    accepted_val = value
-                    response = f"PHASE2B {rnd} {value} {id}"  # Include acceptor ID
-                    acceptor_socket.sendto(response.encode(), CONFIG['proposers'])
-
-            elif msg.startswith("END_"):
-                break
+            with open(self._path("checkpoint"), "rb") as file:
+                data = file.read(CHECKPOINT.size)
+            fields = CHECKPOINT.unpack(data)
+            if zlib.crc32(data[:-4]) == fields[-1]:
+                return fields[:-1]
+        except (OSError, struct.error):
+            pass
+        return 0, 0, 0, 0, 0
 
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print(f"Acceptor {id} error: {e}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
-
-
-def learner(CONFIG, id):
-    learner_socket = create_multicast_socket()
-    proposer_socket = create_multicast_socket()
-    
-    learner_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**18)
-    
-    learner_addr, learner_port = CONFIG['learners']
-    join_multicast_group(learner_socket, learner_addr, learner_port)
-    
-    print(f"Starting Learner {id}", file=sys.stderr)
-    
-    learned_values = set()
-    learned_values_ordered = []
-    last_value_time = time.time()
-    
-    # Timing controls for resends
-    last_resend_time = time.time()
-    start_time = time.time()
-    RESEND_INTERVAL = 0.5
-    RESEND_BATCH_SIZE = 100
-    
-    client_value_counts = {}
-    values_learned = 0
-    
-    # Add a catch-up mechanism when learner starts
-    if id == 2:  # For the late-starting learner
-        # Request catch-up from other learners
-        catch_up_msg = f"CATCHUP_REQUEST_{id}"
-        for _ in range(3):  # Send multiple times for reliability
-            learner_socket.sendto(catch_up_msg.encode(), CONFIG['learners'])
-            time.sleep(0.01)
-
-    while True:
+    def _write_checkpoint(self):
+        self.index.flush()
+        os.fsync(self.index_file.fileno())
+        data = CHECKPOINT.pack(self.leader_rnd, self.leader_from, self.log_end, self.generation, self.base, 0)[:-4]
+        data += struct.pack("!I", zlib.crc32(data))
+        temp_path = self._path("checkpoint.tmp")
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._path("checkpoint"))
+        directory = os.open(self.directory, os.O_RDONLY)
         try:
-            current_time = time.time()
-            
-            # Controlled resend mechanism
-            if current_time - last_resend_time > RESEND_INTERVAL:
-                total_expected_values = sum(client_value_counts.values())
-                if total_expected_values > 0 and values_learned < total_expected_values:
-                    unsent_values = [v for v in learned_values_ordered if not v.startswith("END_")]
-                    for i in range(0, len(unsent_values), RESEND_BATCH_SIZE):
-                        batch = unsent_values[i:i + RESEND_BATCH_SIZE]
-                        for value in batch:
-                            resend_msg = f"DECISION {value}"
-                            learner_socket.sendto(resend_msg.encode(), CONFIG['learners'])
-                            time.sleep(0.001)  # Small delay between messages
-                        
-                last_resend_time = current_time
-            
-            msg = None
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.records_since_checkpoint = 0
+
+    def _recover(self):
+        self.leader_rnd, self.leader_from, offset, generation, base = self._read_checkpoint()
+        self._open_generation(generation, base)
+        replayed = self._replay(offset)
+        if self.base and self.snapshot is None:
+            self.snapshot = self._read_snapshot()
+        self._write_checkpoint()
+        logger.info("Acceptor log %s: replayed %d records of generation %d after checkpoint at offset %d",
+                    self.directory, replayed, generation, offset)
+
+    def _replay(self, offset):
+        """Apply the records from offset on, up to the first torn one, which is cut off"""
+        self.log.seek(offset)
+        data = self.log.read()
+        position = 0
+        replayed = 0
+        while position + WAL_RECORD.size <= len(data):
+            crc, kind, instance, rnd, length = WAL_RECORD.unpack_from(data, position)
+            end = position + WAL_RECORD.size + length
+            if end > len(data) or zlib.crc32(data[position + 4:end]) != crc:
+                break
+            if kind == WAL_SNAPSHOT:
+                self.snapshot = data[position + WAL_RECORD.size:end]
+            else:
+                self._apply(kind, instance, rnd, offset + position)
+            position = end
+            replayed += 1
+        self.log_end = offset + position
+        self.log.truncate(self.log_end)
+        return replayed
+
+    def _read_snapshot(self):
+        # A generation with a base starts with its snapshot record
+        crc, kind, instance, rnd, length = WAL_RECORD.unpack(os.pread(self.log.fileno(), WAL_RECORD.size, 0))
+        if kind != WAL_SNAPSHOT:
+            return None
+        return os.pread(self.log.fileno(), length, WAL_RECORD.size)
+
+    def _apply(self, kind, instance, rnd, offset):
+        if kind == WAL_LEADER:
+            self.leader_rnd, self.leader_from = rnd, instance
+            return
+        promised, accepted, value_offset = self._slot(instance)
+        if kind == WAL_ACCEPT:
+            accepted, value_offset = rnd, offset
+        self._set_slot(instance, (max(promised, rnd), accepted, value_offset))
+
+    @staticmethod
+    def _record(kind, instance, rnd, value=b""):
+        record = WAL_RECORD.pack(0, kind, instance, rnd, len(value))[4:] + value
+        return struct.pack("!I", zlib.crc32(record)) + record
+
+    def append(self, kind, instance, rnd, value=b""):
+        record = self._record(kind, instance, rnd, value)
+        offset = self.log_end + sum(len(pending) for pending in self.pending)
+        self.pending.append(record)
+        if kind == WAL_LEADER:
+            self.leader_rnd, self.leader_from = rnd, instance
+        else:
+            promised, accepted, value_offset = self.dirty_slots.get(instance) or self._slot(instance)
+            if kind == WAL_ACCEPT:
+                accepted, value_offset = rnd, offset
+                self.pending_values[instance] = value
+            self.dirty_slots[instance] = (max(promised, rnd), accepted, value_offset)
+
+    def sync(self):
+        """Group commit: one write and one fsync for every record appended since the last sync"""
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        self.log.write(data)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_end += len(data)
+        self.records_since_checkpoint += len(self.pending)
+        self.pending = []
+        # The index only ever points at records that are on disk
+        for instance, slot in self.dirty_slots.items():
+            self._set_slot(instance, slot)
+        self.dirty_slots = {}
+        self.pending_values = {}
+        if self.records_since_checkpoint >= self.CHECKPOINT_RECORDS:
+            self._write_checkpoint()
+
+    def compact(self, base, snapshot, states):
+        """Start a new generation holding the snapshot of every instance below base
+        and, from states, the (instance, promised, accepted round, value) of the others"""
+        self.sync()
+        old_generation = self.generation
+        records = [self._record(WAL_SNAPSHOT, base, 0, snapshot),
+                   self._record(WAL_LEADER, self.leader_from, self.leader_rnd)]
+        for instance, promised, accepted, value in states:
+            if accepted:
+                records.append(self._record(WAL_ACCEPT, instance, accepted, value))
+            if promised > accepted:
+                records.append(self._record(WAL_PROMISE, instance, promised))
+        self._open_generation(old_generation + 1, base, fresh=True)
+        self.log.write(b"".join(records))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self._replay(0)
+        self._write_checkpoint()  # From here on recovery uses the new generation
+        for name in (f"log.{old_generation}", f"index.{old_generation}"):
             try:
-                msg, addr = learner_socket.recvfrom(2**16)
-                msg = msg.decode().strip()
-                current_time = time.time()
-            except socket.timeout:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def value(self, instance):
+        """The value accepted in an instance, read from the log at the offset the index holds"""
+        value = self.pending_values.get(instance)
+        if value is not None:
+            return value
+        offset = self._slot(instance)[2]
+        header = os.pread(self.log.fileno(), WAL_RECORD.size, offset)
+        length = WAL_RECORD.unpack(header)[4]
+        return os.pread(self.log.fileno(), length, offset + WAL_RECORD.size)
+
+    def rounds(self):
+        """(instance, promised round, accepted round) of every instance the acceptor has
+        promised or accepted something for, from the index alone"""
+        for position in range(self.slots):
+            promised, accepted, offset = INDEX_SLOT.unpack_from(self.index, position * INDEX_SLOT.size)
+            if promised:
+                yield self.base + position, promised, accepted
+
+    def close(self):
+        self.sync()
+        self._write_checkpoint()
+        self.index.close()
+        self.index_file.close()
+        self.log.close()
+
+
+def acceptor(CONFIG, id, loop):
+    acceptor_socket = loop.open_socket(CONFIG['acceptors'])
+    metrics = loop.metrics
+
+    logger.info("Starting Acceptor %d in group %d", id, CONFIG.get('group', 0))
+
+    # Per-instance state: instance -> round number / encoded batch. With a write-ahead
+    # log the accepted batches stay on disk and are read through its index when needed.
+    promised_rnd = {}
+    accepted_rnd = {}
+    accepted_val = {}
+    # Promise made to a stable leader for every instance >= leader_from
+    leader_rnd = 0
+    leader_from = 0
+    chosen = set()  # Instances whose accepted batch is known to be decided
+    shutdown_time = None
+    DIRECT_VOTES = CONFIG.get('direct_votes', 0)  # Votes also go to the learners
+
+    # Fast Paxos: in the fast round the leader opened, a client value is accepted as soon
+    # as it arrives, in the next instance of the round we have not voted in yet. Values
+    # arriving while no fast round is open wait in the backlog.
+    FAST_PAXOS = CONFIG.get('fast_paxos', 0)
+    FAST_BACKLOG = 4096
+    fast_rnd = 0
+    fast_next = 0  # Instance the next client value goes to
+    fast_values = set()  # Values accepted in the current fast round, retransmissions are dropped
+    fast_backlog = deque(maxlen=FAST_BACKLOG)  # Drops the oldest values once full, clients retransmit them
+    fast_dropped = 0  # Values dropped from the full backlog since the last fast round opened
+
+    # Checkpoints: once every learner reports the same snapshot for the instances
+    # below some instance, their state is dropped and the snapshot stands in for it
+    total_learners = CONFIG.get('learner_count', 2)  # Learner ids are 1..total_learners
+    MAX_PENDING_SNAPSHOTS = 8
+    pending_snapshots = {}  # first instance not covered -> {learner id: snapshot}
+    truncated_below = 1  # We only keep the instances from here on
+    snapshot = b""  # Covers every instance below truncated_below
+
+    # With a write-ahead log, promises and accepts survive a crash. Replies wait in
+    # the outbox until the records they depend on are on disk.
+    wal = None
+    outbox = []
+    GROUP_COMMIT_MAX = 256  # Messages handled per fsync at most
+    if CONFIG.get('wal_dir'):
+        group = CONFIG.get('group', 0)
+        wal = AcceptorLog(os.path.join(CONFIG['wal_dir'], f"acceptor-{id}" + (f"-group-{group}" if group else "")))
+        leader_rnd, leader_from = wal.leader_rnd, wal.leader_from
+        if wal.snapshot is not None:
+            truncated_below, snapshot = wal.base, wal.snapshot
+        for instance, promised, accepted in wal.rounds():
+            promised_rnd[instance] = promised
+            if accepted:
+                accepted_rnd[instance] = accepted
+        logger.info("Acceptor %d: Recovered %d instances, leader round %d from instance %d",
+                    id, len(promised_rnd), leader_rnd, leader_from)
+
+    # Catch-up answers to lagging learners are rate limited with a token bucket
+    CATCHUP_RATE = CONFIG.get('catchup_rate', 8000000)  # Bytes per second
+    CATCHUP_BURST = 0.1  # Seconds worth of tokens we can spend at once
+    CATCHUP_LINGER = 5.0  # Keep serving learners this long after SHUTDOWN
+    catchup_tokens = CATCHUP_RATE * CATCHUP_BURST
+    last_refill_time = loop.time()
+    last_catchup_time = loop.time()
+
+    def promise_for(instance):
+        if instance >= leader_from:
+            return max(promised_rnd.get(instance, 0), leader_rnd)
+        return promised_rnd.get(instance, 0)
+
+    def accepted_value(instance):
+        return wal.value(instance) if wal else accepted_val[instance]
+
+    def snapshot_message():
+        return encode_message(SNAPSHOT, id, 0, truncated_below, payload=snapshot)
+
+    def on_phase1a(msg):
+        nonlocal leader_rnd, leader_from
+        rnd = msg.ballot
+        instance = msg.instance
+        reports = None
+
+        if instance < truncated_below:
+            # We no longer know what was accepted there: the proposer must install
+            # the snapshot and run Phase 1 again for the instances after it
+            outbox.append((snapshot_message(), CONFIG['proposers']))
+        elif msg.flags & FLAG_ALL_INSTANCES:
+            # Stable leader: one promise covers this instance and every later one
+            if rnd >= leader_rnd:
+                leader_rnd = rnd
+                leader_from = min(leader_from, instance) if leader_from else instance
+                if wal:
+                    wal.append(WAL_LEADER, leader_from, leader_rnd)
+                reports = [(inst, accepted_rnd[inst], accepted_value(inst))
+                           for inst in sorted(accepted_rnd) if inst >= instance]
+
+        elif rnd >= promise_for(instance):
+            promised_rnd[instance] = rnd
+            if wal:
+                wal.append(WAL_PROMISE, instance, rnd)
+            reports = []
+            if instance in accepted_rnd:
+                reports.append((instance, accepted_rnd[instance], accepted_value(instance)))
+
+        if reports is None:
+            metrics.count('acceptor.rejects')
+        else:
+            metrics.count('acceptor.promises')
+            # Include acceptor ID and how many accepted instances we report,
+            # splitting the reports over as many datagrams as needed
+            chunk = []
+            chunk_bytes = HEADER.size
+            for report in reports:
+                report_bytes = REPORT.size + len(report[2])
+                if chunk and chunk_bytes + report_bytes > MAX_DATAGRAM:
+                    response = encode_message(PHASE1B, id, rnd, instance, aux=len(reports), payload=encode_reports(chunk))
+                    outbox.append((response, CONFIG['proposers']))
+                    chunk = []
+                    chunk_bytes = HEADER.size
+                chunk.append(report)
+                chunk_bytes += report_bytes
+            response = encode_message(PHASE1B, id, rnd, instance, aux=len(reports), payload=encode_reports(chunk))
+            outbox.append((response, CONFIG['proposers']))
+
+    def accept(instance, rnd, value):
+        metrics.count('acceptor.accepts')
+        promised_rnd[instance] = rnd
+        accepted_rnd[instance] = rnd
+        if wal:
+            wal.append(WAL_ACCEPT, instance, rnd, value)
+        else:
+            accepted_val[instance] = value  # Kept encoded, acceptors never look inside
+
+    def on_phase2a(msg):
+        rnd = msg.ballot
+        instance = msg.instance
+
+        if msg.flags & FLAG_ANY:
+            open_fast_round(rnd, instance)
+        elif instance < truncated_below:
+            outbox.append((snapshot_message(), CONFIG['proposers']))
+        elif rnd >= promise_for(instance):
+            accept(instance, rnd, msg.payload)
+            response = encode_message(PHASE2B, id, rnd, instance)  # Include acceptor ID
+            outbox.append((response, CONFIG['proposers']))
+            if DIRECT_VOTES:
+                outbox.append((response, CONFIG['learners']))
+        else:
+            metrics.count('acceptor.rejects')
+
+    def open_fast_round(rnd, first):
+        nonlocal fast_rnd, fast_next, fast_dropped
+        if rnd <= fast_rnd or rnd < leader_rnd:
+            return  # Already open, or we promised a newer leader
+        fast_rnd = rnd
+        fast_next = max(first, truncated_below)
+        fast_values.clear()
+        logger.info("Acceptor %d: Fast round %d open for instances >= %d", id, rnd, first)
+        if fast_dropped:
+            logger.warning("Acceptor %d: Dropped %d client values from the full backlog before fast round %d opened",
+                           id, fast_dropped, rnd)
+            fast_dropped = 0
+        while fast_backlog:
+            accept_client_value(fast_backlog.popleft())
+
+    def accept_client_value(value):
+        """Vote for an encoded single-entry batch in the fast round, the value itself
+        goes with the PHASE2B since each acceptor picks the instance on its own"""
+        nonlocal fast_next, fast_dropped
+        if not fast_rnd or fast_rnd < leader_rnd:
+            if len(fast_backlog) == FAST_BACKLOG:
+                if not fast_dropped:
+                    logger.warning("Acceptor %d: Fast backlog full (%d values), dropping the oldest ones",
+                                   id, FAST_BACKLOG)
+                fast_dropped += 1
+                metrics.count('acceptor.fast_backlog_dropped')
+            fast_backlog.append(value)  # The current leader has not opened its fast round yet
+            return
+        if value in fast_values:
+            return
+        while accepted_rnd.get(fast_next, 0) >= fast_rnd or promise_for(fast_next) > fast_rnd:
+            fast_next += 1  # Voted before a restart, or promised to a classic round
+        instance = fast_next
+        fast_next += 1
+        fast_values.add(value)
+        accept(instance, fast_rnd, value)
+        vote = encode_message(PHASE2B, id, fast_rnd, instance, payload=value)
+        outbox.append((vote, CONFIG['proposers']))
+        outbox.append((vote, CONFIG['learners']))
+
+    # Both build the single-entry batch encode_batch would, straight from the message
+    def on_client_value(msg):
+        if b"\n" not in msg.payload:  # Values are single lines
+            accept_client_value(SMALL_BATCHES[1].pack(0, 1, msg.sender, msg.aux) + msg.payload)
+
+    def on_client_end(msg):
+        accept_client_value(BATCH_HEADER.pack(1, 0) + END_ENTRY.pack(msg.sender, msg.aux))
+
+    def on_commit(msg):
+        for instance, rnd, crc in COMMIT_ENTRY.iter_unpack(msg.payload):
+            if (instance not in chosen and accepted_rnd.get(instance) == rnd and
+                    zlib.crc32(accepted_value(instance)) == crc):
+                chosen.add(instance)
+
+    def on_snapshot(msg):
+        base = msg.instance
+        if base <= truncated_below:
+            return
+        reports = pending_snapshots.setdefault(base, {})
+        reports[msg.sender] = msg.payload
+        while len(pending_snapshots) > MAX_PENDING_SNAPSHOTS:
+            del pending_snapshots[min(pending_snapshots)]
+        if any(learner_id not in reports for learner_id in range(1, total_learners + 1)):
+            return
+        if len(set(reports.values())) > 1:
+            logger.warning("Acceptor %d: Learners disagree on the snapshot below instance %d, not truncating", id, base)
+            return
+        truncate(base, msg.payload)
+
+    def truncate(base, new_snapshot):
+        """Drop the state of every instance below base, which new_snapshot covers"""
+        nonlocal truncated_below, snapshot
+        for instance in range(truncated_below, base):
+            promised_rnd.pop(instance, None)
+            accepted_rnd.pop(instance, None)
+            accepted_val.pop(instance, None)
+            chosen.discard(instance)
+        for pending_base in [pending_base for pending_base in pending_snapshots if pending_base <= base]:
+            del pending_snapshots[pending_base]
+        truncated_below = base
+        snapshot = new_snapshot
+        if wal:
+            wal.compact(base, snapshot, [(instance, promised_rnd[instance], accepted_rnd.get(instance, 0),
+                                          accepted_value(instance) if instance in accepted_rnd else None)
+                                         for instance in sorted(promised_rnd)])
+        logger.info("Acceptor %d: Truncated the log below instance %d, %d instances left", id, base, len(promised_rnd))
+
+    def on_catchup_request(msg):
+        nonlocal catchup_tokens, last_refill_time, last_catchup_time
+        (responder,) = RESPONDER.unpack(msg.payload)
+        if responder != id:
+            return
+        current_time = loop.time()
+        last_catchup_time = current_time
+        catchup_tokens = min(catchup_tokens + (current_time - last_refill_time) * CATCHUP_RATE,
+                             CATCHUP_RATE * CATCHUP_BURST)
+        last_refill_time = current_time
+        if catchup_tokens <= 0:
+            metrics.count('acceptor.catchup_refused')
+            return  # Over our rate: the learner will ask another acceptor
+        metrics.count('acceptor.catchup_requests')
+
+        first = msg.instance
+        if first < truncated_below:
+            # Part of the range was truncated: the learner installs the snapshot instead
+            loop.send(acceptor_socket, snapshot_message(), CONFIG['learners'])
+            catchup_tokens -= HEADER.size + len(snapshot)
+            metrics.count('acceptor.catchup_bytes', HEADER.size + len(snapshot))
+            first = truncated_below
+
+        # Answer with the chosen instances of the range, packed into as few datagrams as possible
+        chunk = []
+        chunk_bytes = HEADER.size
+        for instance in range(first, msg.instance + msg.aux):
+            if instance not in chosen:
                 continue
+            report = (instance, accepted_rnd[instance], accepted_value(instance))
+            report_bytes = REPORT.size + len(report[2])
+            if chunk and chunk_bytes + report_bytes > MAX_DATAGRAM:
+                if catchup_tokens < chunk_bytes:
+                    break  # The learner asks again for the rest
+                response = encode_message(CATCHUP_REPLY, id, 0, msg.instance, payload=encode_reports(chunk))
+                loop.send(acceptor_socket, response, CONFIG['learners'])
+                catchup_tokens -= chunk_bytes
+                metrics.count('acceptor.catchup_bytes', chunk_bytes)
+                chunk = []
+                chunk_bytes = HEADER.size
+            chunk.append(report)
+            chunk_bytes += report_bytes
+        response = encode_message(CATCHUP_REPLY, id, 0, msg.instance, payload=encode_reports(chunk),
+                                  flags=FLAG_LAST_CHUNK)
+        loop.send(acceptor_socket, response, CONFIG['learners'])
+        catchup_tokens -= chunk_bytes
+        metrics.count('acceptor.catchup_bytes', chunk_bytes)
+        logger.debug("Acceptor %d: Served catch-up for instances %d-%d to learner %d",
+                     id, msg.instance, msg.instance + msg.aux - 1, msg.sender)
 
-            if msg.startswith("DECISION"):
-                time.sleep(0.0005)
-                _, value = msg.split()
-                
-                # Handle END messages with value counts
-                if value.startswith("END_"):
-                    parts = value.split('_')
-                    if len(parts) > 2:  # Format: END_clientId_valueCount
-                        client_id = int(parts[1])
-                        value_count = int(parts[2])
-                        client_value_counts[client_id] = value_count
-                
-                if value not in learned_values:
-                    learned_values.add(value)
-                    learned_values_ordered.append(value)
-                    last_value_time = current_time
-                    
-                    if not value.startswith("END_"):
-                        values_learned += 1
-                        print(value)
-                        sys.stdout.flush()
-                        
-                        # Always forward decisions to help other learners catch up
-                        learner_socket.sendto(msg.encode(), CONFIG['learners'])
-                        time.sleep(0.0005)
-
-            # Add handling for catch-up requests
-            elif msg.startswith("CATCHUP_REQUEST"):
-                # Send all known values to the requesting learner
-                for value in learned_values_ordered:
-                    if not value.startswith("END_"):
-                        catch_up_msg = f"DECISION {value}"
-                        learner_socket.sendto(catch_up_msg.encode(), CONFIG['learners'])
-                        time.sleep(0.001)  # Small delay to prevent overwhelming network
-
-            # Modified termination condition
-            total_expected_values = sum(client_value_counts.values())
-            if (len(client_value_counts) >= 2 and  # Received counts from both clients
-                total_expected_values > 0 and      # Have valid counts
-                values_learned >= total_expected_values):  # Learned all values
-                if current_time - last_value_time > 3.0:  # Wait a bit to ensure no more values
-                    print(f"Learner {id}: Total values learned: {values_learned}/{total_expected_values}", 
-                          file=sys.stderr)
-                    break
+    def on_shutdown(msg):
+        nonlocal shutdown_time, linger_timer
+        if shutdown_time is None:
+            shutdown_time = loop.time()
+            linger_timer = loop.call_every(1.0, check_linger)
 
-        except socket.timeout:
-            continue
-            
-        except Exception as e:
-            print(f"Learner {id} error: {e}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
-
-def client(CONFIG, client_id):
-    client_socket = create_multicast_socket()
-    proposer_addr, proposer_port = CONFIG['proposers']
-    
-    print(f"Client {client_id}: Starting. Will send to {proposer_addr}:{proposer_port}", file=sys.stderr)
-    
-    start_time = time.time()
-    values_sent = 0
-    last_report_time = time.time()
-    
-    try:
+    def check_linger():
+        if loop.time() - max(shutdown_time, last_catchup_time) > CATCHUP_LINGER:
+            # Proposers are done and no learner is still catching up
+            linger_timer.cancel()
+            loop.remove_reader(acceptor_socket)
+            if wal:
+                wal.close()
+
+    handlers = {
+        PHASE1A: on_phase1a,
+        PHASE2A: on_phase2a,
+        COMMIT: on_commit,
+        CATCHUP_REQUEST: on_catchup_request,
+        SHUTDOWN: on_shutdown,
+        SNAPSHOT: on_snapshot,
+    }
+    if FAST_PAXOS:
+        handlers[CLIENT_VALUE] = on_client_value
+        handlers[CLIENT_END] = on_client_end
+
+    def on_datagram(data, current_time):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for msg in decode_messages(data):
+            if debug:
+                logger.debug("Acceptor %d received: %s round %d instance %d from %d",
+                             id, MESSAGE_NAMES.get(msg.type, msg.type), msg.ballot, msg.instance, msg.sender)
+            handler = handlers.get(msg.type)
+            if handler and (shutdown_time is None or msg.type in (CATCHUP_REQUEST, COMMIT)):
+                handler(msg)
+
+    def on_drained(current_time):
+        # Group commit: one fsync covers every message handled since the socket became readable,
+        # and no reply leaves before the records it depends on are on disk
+        if wal and wal.pending:
+            metrics.count('acceptor.wal_syncs')
+            wal.sync()
+            metrics.observe('acceptor.wal_sync', loop.time() - current_time)
+        for response, group in outbox:
+            loop.send(acceptor_socket, response, group)
+        outbox.clear()
+
+    linger_timer = None
+    metrics.gauge('acceptor.instances', lambda: len(promised_rnd))
+    if FAST_PAXOS:
+        metrics.gauge('acceptor.fast_backlog', lambda: len(fast_backlog))
+    loop.add_datagram_reader(acceptor_socket, on_datagram, on_drained,
+                             limit=GROUP_COMMIT_MAX if wal else EventLoop.DRAIN_LIMIT)
+
+
+class LogMerger:
+    """Merges the logs of several Paxos groups into one total order: instance 1 of
+    group 0, of group 1, ..., then instance 2 of every group, and so on. Every
+    learner merges the same decided logs the same way, so they print the same
+    sequence. A group whose values are all learned no longer holds the others back,
+    whatever instances it still decides are empty or repeat learned values."""
+
+    def __init__(self, groups, write):
+        self.write = write  # Called with the new values of every merged instance
+        self.queues = [deque() for _ in range(groups)]  # (last instance covered, values, on_merged)
+        self.complete = [False] * groups
+        self.instance = 1  # Next instance to merge, of group self.turn
+        self.turn = 0
+
+    def put(self, group, last, values, on_merged=None):
+        """The group delivered its instances up to last, which hold values (a snapshot
+        covers a range without values). on_merged() runs once they are merged"""
+        self.queues[group].append((last, values, on_merged))
+
+    def finish(self, group):
+        self.complete[group] = True
+
+    def merge(self):
+        """Merge what the groups delivered, return the on_merged callbacks that are due"""
+        due = []
         while True:
-            try:
-                value = input().strip()
-                if value:
-                    print(f"Client {client_id}: Sending value: {value}", file=sys.stderr)
-                    for _ in range(3):
-                        client_socket.sendto(value.encode(), (proposer_addr, proposer_port))
-                        time.sleep(0.01)  # Reduced delay
-                    values_sent += 1
-                    
-                    current_time = time.time()
-                    if current_time - last_report_time >= 1.0:
-                        print(f"Client {client_id}: Sent {values_sent} values so far", file=sys.stderr)
-                        last_report_time = current_time
-            except EOFError:
-                print(f"Client {client_id}: Reached end of input", file=sys.stderr)
+            queue = self.queues[self.turn]
+            if queue:
+                last, values, on_merged = queue[0]
+                if self.instance == last:
+                    queue.popleft()
+                    self.write(values)
+                    if on_merged:
+                        due.append(on_merged)
+            elif not self.complete[self.turn]:
+                return due
+            self.turn += 1
+            if self.turn == len(self.queues):
+                self.turn = 0
+                self.instance += 1
+                if all(self.complete) and not any(self.queues):
+                    return due
+
+def learner(CONFIG, id, loop, output=None):
+    """Print the learned values on output (stdout by default) in log order. With
+    groups > 1 follow the log of every group and print them merged by LogMerger"""
+    output = output or sys.stdout
+    GROUPS = CONFIG.get('groups', 1)
+    metrics = loop.metrics
+
+    logger.info("Starting Learner %d", id)
+
+    # Merged values are written out in bulk, once OUTPUT_BATCH lines are waiting
+    # or the oldest of them waited OUTPUT_DELAY seconds
+    OUTPUT_BATCH = CONFIG.get('output_batch', 1024)
+    OUTPUT_DELAY = CONFIG.get('output_delay', 0.01)
+    pending_output = []
+    output_timer = None
+    merger = LogMerger(GROUPS, pending_output.extend)
+    totals = {}  # group -> (values learned, values expected), once the group is done
+    metrics.gauge('learner.output_pending', lambda: len(pending_output))
+
+    def merge():
+        nonlocal output_timer
+        checkpoints = merger.merge()
+        if checkpoints:
+            flush_output()  # Acceptors may drop what a snapshot covers once it is out
+            for send_checkpoint in checkpoints:
+                send_checkpoint()
+        if len(pending_output) >= OUTPUT_BATCH:
+            flush_output()
+        elif pending_output and output_timer is None:
+            output_timer = loop.call_later(OUTPUT_DELAY, flush_output)
+
+    def flush_output():
+        nonlocal output_timer
+        if output_timer:
+            output_timer.cancel()
+            output_timer = None
+        if pending_output:
+            output.write("\n".join(pending_output) + "\n")
+            output.flush()
+            pending_output.clear()
+
+    def on_group_done(group, learned, expected):
+        totals[group] = (learned, expected)
+        merger.finish(group)
+        merge()
+        if len(totals) == GROUPS:
+            flush_output()
+            logger.info("Learner %d: Total values learned: %d/%d", id,
+                        sum(learned for learned, _ in totals.values()), sum(expected for _, expected in totals.values()))
+
+    for group in range(GROUPS):
+        learner_group(group_config(CONFIG, group) if GROUPS > 1 else CONFIG, id, loop, merger, merge, on_group_done)
+
+def learner_group(CONFIG, id, loop, merger, merge, on_done):
+    """Learn the decided log of one group and hand its instances to merger in order"""
+    learner_socket = loop.open_socket(CONFIG['learners'])
+    metrics = loop.metrics
+    GROUP = CONFIG.get('group', 0)
+
+    learned_requests = RequestSet()
+    decisions = {}  # instance -> decided batch still encoded, until it is delivered
+    next_to_deliver = 1  # Values are printed in instance order
+    highest_known = 0  # Highest instance we know to be decided
+    last_value_time = loop.time()
+
+    # Gap-driven catch-up: when the log has a hole for a while, ask one acceptor
+    # for the missing range; it answers in bulk with the batches it knows are chosen
+    GAP_DELAY = 0.05  # Decisions of pipelined instances arrive out of order
+    CATCHUP_TIMEOUT = 0.3  # Until an acceptor's answer time was measured
+    CATCHUP_MAX_INSTANCES = 10000
+    total_acceptors, _, PHASE2_QUORUM = quorum_sizes(CONFIG)  # Acceptor ids are 1..total_acceptors
+    gap_since = None
+    gap_timer = None
+    catchup_attempts = 0
+    catchup_request = None  # (first instance asked for, last one, deadline, acceptor asked, send time)
+    acceptor_rtt = {}  # acceptor id -> RttEstimator of its catch-up answers
+    done_timer = None
+
+    # Every CHECKPOINT_INTERVAL instances we send acceptors a snapshot of what we
+    # delivered, so that they can truncate their log once all learners agree
+    CHECKPOINT_INTERVAL = CONFIG.get('checkpoint_interval', 1000)
+
+    # Direct votes: with the leader's PHASE2A and the acceptors' PHASE2B we count the
+    # votes ourselves, a batch is chosen once a Phase 2 quorum accepted it in the same round.
+    # Votes of a fast round carry the batch, which is chosen once a fast quorum voted for it.
+    proposals = {}  # instance -> {round: batch proposed in it}
+    votes = {}  # instance -> {(round, batch voted for, empty unless the round is fast): acceptors}
+    FAST_QUORUM = fast_quorum_size(CONFIG) if CONFIG.get('fast_paxos') else None
+
+    client_value_counts = {}
+    CLIENT_COUNT = CONFIG.get('client_count', 2)
+
+    def learn(instance, batch_payload):
+        nonlocal highest_known, last_value_time
+        highest_known = max(highest_known, instance)
+        if instance >= next_to_deliver and instance not in decisions:
+            decisions[instance] = batch_payload
+            last_value_time = loop.time()
+        proposals.pop(instance, None)
+        votes.pop(instance, None)
+
+    def is_learned(instance):
+        return instance < next_to_deliver or instance in decisions
+
+    def learn_if_chosen(instance, rnd):
+        batch_payload = proposals.get(instance, {}).get(rnd)
+        if batch_payload is not None and len(votes.get(instance, {}).get((rnd, b""), ())) >= PHASE2_QUORUM:
+            learn(instance, batch_payload)
+            deliver()
+
+    def deliver():
+        nonlocal next_to_deliver
+        # Deliver the contiguous prefix of the log
+        while next_to_deliver in decisions:
+            instance = next_to_deliver
+            client_ids, seqs, encoded_values, ends = decode_batch_columns(decisions.pop(instance))
+            next_to_deliver += 1
+            metrics.count('learner.instances')
+
+            values = []
+            if client_ids:
+                add_id = learned_requests.add_id
+                values = [value for client_id, seq, value in zip(client_ids, seqs, decode_values(encoded_values))
+                          if add_id(client_id, seq)]
+                metrics.count('learner.values', len(values))
+            for end in ends:
+                client_value_counts[end.client_id] = end.count
+
+            send_checkpoint = None
+            if CHECKPOINT_INTERVAL and instance % CHECKPOINT_INTERVAL == 0:
+                snapshot_message = encode_message(SNAPSHOT, id, 0, next_to_deliver,
+                                                  payload=encode_snapshot(learned_requests, client_value_counts))
+                send_checkpoint = lambda message=snapshot_message: loop.send(learner_socket, message, CONFIG['acceptors'])
+            merger.put(GROUP, instance, values, send_checkpoint)
+        merge()
+
+    def rtt_of(acceptor_id):
+        estimator = acceptor_rtt.get(acceptor_id)
+        if estimator is None:
+            estimator = acceptor_rtt[acceptor_id] = RttEstimator(CATCHUP_TIMEOUT, 0.01, 2.0)
+        return estimator
+
+    def request_catchup(current_time):
+        nonlocal catchup_attempts, catchup_request
+        if catchup_request and current_time >= catchup_request[2]:
+            rtt_of(catchup_request[3]).expired()
+        last = min(highest_known, next_to_deliver + CATCHUP_MAX_INSTANCES - 1)
+        responder = 1 + catchup_attempts % total_acceptors
+        catchup_attempts += 1
+        catchup_request = (next_to_deliver, last, current_time + rtt_of(responder).timeout(), responder, current_time)
+        logger.info("Learner %d: Requesting instances %d-%d from acceptor %d", id, next_to_deliver, last, responder)
+        metrics.count('learner.catchup_requests')
+        request = encode_message(CATCHUP_REQUEST, id, 0, next_to_deliver, aux=last - next_to_deliver + 1,
+                                 payload=RESPONDER.pack(responder))
+        loop.send(learner_socket, request, CONFIG['acceptors'])
+
+    def on_decision(msg, current_time):
+        nonlocal highest_known
+        if msg.payload:
+            learn(msg.instance, msg.payload)
+        elif not is_learned(msg.instance):
+            # Summary of a decision whose batch came with the PHASE2A
+            batch_payload = proposals.get(msg.instance, {}).get(msg.ballot)
+            if batch_payload is not None:
+                learn(msg.instance, batch_payload)
+            else:
+                highest_known = max(highest_known, msg.instance)  # Fetched by catch-up
+        deliver()
+
+    def on_phase2a(msg, current_time):
+        if not is_learned(msg.instance):
+            proposals.setdefault(msg.instance, {})[msg.ballot] = msg.payload
+            learn_if_chosen(msg.instance, msg.ballot)
+
+    def on_phase2b(msg, current_time):
+        if not is_learned(msg.instance):
+            voters = votes.setdefault(msg.instance, {}).setdefault((msg.ballot, msg.payload), set())
+            voters.add(msg.sender)
+            if not msg.payload:
+                learn_if_chosen(msg.instance, msg.ballot)
+            elif len(voters) >= FAST_QUORUM:
+                learn(msg.instance, msg.payload)
+                deliver()
+
+    def on_catchup_reply(msg, current_time):
+        nonlocal catchup_request, catchup_attempts
+        metrics.count('learner.catchup_bytes', len(msg.payload))
+        for instance, accepted_rnd, batch_payload in decode_reports(msg.payload):
+            learn(instance, batch_payload)
+        deliver()
+        if msg.flags & FLAG_LAST_CHUNK and catchup_request and msg.sender == catchup_request[3]:
+            rtt_of(msg.sender).sample(current_time - catchup_request[4])
+        if msg.flags & FLAG_LAST_CHUNK and catchup_request and next_to_deliver > catchup_request[0]:
+            # Answer complete and useful: ask the same acceptor for whatever is still missing.
+            # An answer that filled nothing waits for the timeout, which moves on to the next acceptor
+            catchup_request = None
+            catchup_attempts -= 1
+
+    def on_snapshot(msg, current_time):
+        nonlocal next_to_deliver, highest_known, last_value_time
+        base = msg.instance
+        if base <= next_to_deliver:
+            return  # We already delivered everything it covers
+        # The log below base is gone: take over the snapshot's state instead. The values
+        # we skip are the ones a restarted learner printed before it went down.
+        requests, ends = decode_snapshot(msg.payload)
+        learned_requests.update(requests)
+        for end in ends:
+            client_value_counts[end.client_id] = end.count
+        for instance in [instance for instance in decisions if instance < base]:
+            del decisions[instance]
+        for pending in (proposals, votes):
+            for instance in [instance for instance in pending if instance < base]:
+                del pending[instance]
+        logger.info("Learner %d: Installed snapshot of instances %d-%d from acceptor %d", id, next_to_deliver, base - 1, msg.sender)
+        merger.put(GROUP, base - 1, [])
+        next_to_deliver = base
+        highest_known = max(highest_known, base - 1)
+        last_value_time = current_time
+        deliver()
+
+    def on_log_tip(msg, current_time):
+        nonlocal highest_known
+        # Heartbeats and SHUTDOWN carry the proposer's first undecided instance
+        highest_known = max(highest_known, msg.instance - 1)
+
+    handlers = {
+        DECISION: on_decision,
+        PHASE2A: on_phase2a,
+        PHASE2B: on_phase2b,
+        CATCHUP_REPLY: on_catchup_reply,
+        SNAPSHOT: on_snapshot,
+        HEARTBEAT: on_log_tip,
+        SHUTDOWN: on_log_tip,
+    }
+
+    def on_datagram(data, current_time):
+        for msg in decode_messages(data):
+            handler = handlers.get(msg.type)
+            if handler:
+                handler(msg, current_time)
+
+    def check_gap():
+        """Ask for the missing part of the log once a hole has lasted GAP_DELAY,
+        and again whenever the outstanding request times out or is answered"""
+        nonlocal gap_since, catchup_request, gap_timer
+        current_time = loop.time()
+        wake_time = None
+        if next_to_deliver > highest_known:
+            gap_since = None
+            catchup_request = None
+        else:
+            if gap_since is None:
+                gap_since = current_time
+            if current_time < gap_since + GAP_DELAY:
+                wake_time = gap_since + GAP_DELAY
+            elif (catchup_request and current_time < catchup_request[2] and
+                  next_to_deliver <= catchup_request[1]):
+                wake_time = catchup_request[2]
+            else:
+                request_catchup(current_time)
+                wake_time = catchup_request[2]
+        if gap_timer and gap_timer.when != wake_time:
+            gap_timer.cancel()
+            gap_timer = None
+        if wake_time is not None and gap_timer is None:
+            gap_timer = loop.call_at(wake_time, on_gap_timer)
+
+    def on_gap_timer():
+        nonlocal gap_timer
+        gap_timer = None
+        check_gap()
+
+    def learned_everything():
+        total_expected_values = sum(client_value_counts.values())
+        return (len(client_value_counts) >= CLIENT_COUNT and  # Received counts from every client
+                len(learned_requests) >= total_expected_values)  # Learned all values
+
+    def check_done():
+        nonlocal done_timer
+        done_timer = None
+        if loop.time() < last_value_time + 3.0:  # Wait a bit to ensure no more values
+            done_timer = loop.call_at(last_value_time + 3.0, check_done)
+            return
+        loop.remove_reader(learner_socket)
+        if gap_timer:
+            gap_timer.cancel()
+        on_done(GROUP, len(learned_requests), sum(client_value_counts.values()))
+
+    def on_drained(current_time):
+        nonlocal done_timer
+        check_gap()
+        if done_timer is None and learned_everything():
+            done_timer = loop.call_at(last_value_time + 3.0, check_done)
+
+    prefix = f"learner.group{GROUP}" if CONFIG.get('groups', 1) > 1 else "learner"
+    metrics.gauge(f"{prefix}.buffered", lambda: len(decisions))
+    metrics.gauge(f"{prefix}.lag", lambda: max(highest_known - next_to_deliver + 1, 0))
+    loop.add_datagram_reader(learner_socket, on_datagram, on_drained)
+
+def client(CONFIG, client_id, loop, values=None):
+    """Submit the lines read from stdin, or the given values, to the proposers (or
+    with fast_paxos to the acceptors)"""
+    # With groups > 1 every value goes to one group, in turn or by a hash of the value,
+    # and is numbered in the sequence of that group
+    GROUPS = CONFIG.get('groups', 1)
+    PARTITION = CONFIG.get('partition', 'round_robin')
+    configs = [group_config(CONFIG, group) if GROUPS > 1 else CONFIG for group in range(GROUPS)]
+    client_sockets = [loop.open_socket(config['client']) for config in configs]  # Decision notifications
+    # With fast_paxos the acceptors take the values themselves. They drop a value they
+    # already voted for, so retransmissions also go to the proposers, which acknowledge
+    # the decided ones.
+    FAST_PAXOS = CONFIG.get('fast_paxos', 0)
+    submit_role = 'acceptors' if FAST_PAXOS else 'proposers'
+    metrics = loop.metrics
+
+    logger.info("Client %d: Starting. Will send to %s:%d", client_id, *CONFIG[submit_role])
+    if GROUPS > 1:
+        logger.info("Client %d: Routing values to %d groups (%s)", client_id, GROUPS, PARTITION)
+
+    # Keep up to window requests outstanding; a request is done when a decision
+    # containing it comes back, and is only sent again if that takes longer than
+    # the measured decision time allows. The window shrinks by half when requests
+    # time out and grows back by about one per window of timely decisions.
+    WINDOW = CONFIG.get('client_window', 64)
+    REQUEST_TIMEOUT = CONFIG.get('client_timeout', 1.0)  # Until a decision time was measured
+    decision_rtt = RttEstimator(REQUEST_TIMEOUT, 0.01, 4 * REQUEST_TIMEOUT)
+    window = float(WINDOW)
+    last_window_cut = 0.0
+    END_RETRIES = 10
+    INPUT_BUFFER = 10000  # Values read ahead from stdin
+
+    input_values = deque(values or ())
+    input_done = values is not None
+    reading_input = False
+    partial_line = b""
+    stdin_fd = None if input_done else sys.stdin.fileno()
+
+    outstanding = OrderedDict()  # (group, seq) -> [value, first send time, last send time], least recently sent first
+    retransmit_timer = None
+    latencies = []
+    values_sent = 0
+    group_values_sent = [0] * GROUPS
+    ended = set()  # Groups that decided our END
+    retransmissions = 0
+    end_timer = None
+    end_attempts = 0
+    first_send_time = None
+    last_ack_time = None
+    finished = False
+
+    def resume_input():
+        nonlocal reading_input
+        if not reading_input:
+            loop.add_reader(stdin_fd, on_input)
+            reading_input = True
+
+    def pause_input():
+        nonlocal reading_input
+        if reading_input:
+            loop.remove_reader(stdin_fd)
+            reading_input = False
+
+    def on_input(current_time):
+        nonlocal input_done, partial_line
+        chunk = os.read(stdin_fd, 2**16)
+        if chunk:
+            lines = (partial_line + chunk).split(b"\n")
+            partial_line = lines.pop()
+        else:
+            logger.info("Client %d: Reached end of input", client_id)
+            lines = [partial_line]
+            input_done = True
+            pause_input()
+        for line in lines:
+            value = line.decode().strip()
+            if value:
+                input_values.append(value)
+        if len(input_values) >= INPUT_BUFFER:
+            pause_input()
+        progress(current_time)
+
+    def send_request(group, seq, value, again=False):
+        value_message = encode_message(CLIENT_VALUE, client_id, aux=seq, payload=value.encode())
+        loop.send(client_sockets[group], value_message, configs[group][submit_role])
+        if again and FAST_PAXOS:
+            loop.send(client_sockets[group], value_message, configs[group]['proposers'])
+
+    def on_retransmit():
+        """Send again the requests that were not decided in time"""
+        nonlocal retransmit_timer, retransmissions, window, last_window_cut
+        retransmit_timer = None
+        current_time = loop.time()
+        timeout = decision_rtt.timeout()
+        expired = False
+        while outstanding:
+            key, request = next(iter(outstanding.items()))
+            if current_time < request[2] + timeout:
                 break
-        
-        # Send end message with value count
-        time.sleep(10.0)
-        end_message = f"END_{client_id}_{values_sent}"
-        for _ in range(3):
-            print(f"Client {client_id}: Sending end message: {end_message}", file=sys.stderr)
-            client_socket.sendto(end_message.encode(), (proposer_addr, proposer_port))
-            time.sleep(0.5)
-        
-        time.sleep(1.0)
-        
-        elapsed_time = time.time() - start_time
-        print(f"Client {client_id}: Finished. Total time for {values_sent} values: {elapsed_time:.2f} seconds ({values_sent/elapsed_time:.2f} values/second)", file=sys.stderr)
-        
-    finally:
-        client_socket.close()
+            expired = True
+            request[2] = current_time
+            outstanding.move_to_end(key)
+            retransmissions += 1
+            metrics.count('client.retransmits')
+            send_request(*key, request[0], again=True)
+        if expired and current_time - last_window_cut > timeout:
+            # One loss event per timeout: requests sent together time out together
+            decision_rtt.expired()
+            window = max(window / 2, 1.0)
+            last_window_cut = current_time
+        progress(current_time)
+
+    def send_end():
+        """Once every value is decided, tell the proposers how many there were"""
+        nonlocal end_timer, end_attempts
+        if end_attempts == END_RETRIES:
+            logger.warning("Client %d: END message was never acknowledged", client_id)
+            finish()
+            return
+        logger.info("Client %d: Sending end message for %d values", client_id, values_sent)
+        for group in range(GROUPS):
+            if group in ended:
+                continue
+            end_message = encode_message(CLIENT_END, client_id, aux=group_values_sent[group])
+            loop.send(client_sockets[group], end_message, configs[group][submit_role])
+            if FAST_PAXOS:
+                loop.send(client_sockets[group], end_message, configs[group]['proposers'])
+        end_attempts += 1
+        end_timer = loop.call_later(decision_rtt.timeout(), send_end)
+
+    def progress(current_time):
+        nonlocal values_sent, first_send_time, retransmit_timer
+        # Fill the window with new values
+        while input_values and len(outstanding) < int(window):
+            value = input_values.popleft()
+            if PARTITION == 'key':
+                group = zlib.crc32(value.encode()) % GROUPS
+            else:
+                group = values_sent % GROUPS
+            values_sent += 1
+            group_values_sent[group] += 1
+            metrics.count('client.values_sent')
+            logger.debug("Client %d: Sending value: %s", client_id, value)
+            outstanding[(group, group_values_sent[group])] = [value, current_time, current_time]
+            send_request(group, group_values_sent[group], value)
+            if first_send_time is None:
+                first_send_time = current_time
+
+        if not input_done and len(input_values) < INPUT_BUFFER // 2:
+            resume_input()
+        if outstanding:
+            # Re-armed when new samples brought the timeout below the pending deadline
+            oldest = next(iter(outstanding.values()))
+            deadline = oldest[2] + decision_rtt.timeout()
+            if retransmit_timer and retransmit_timer.when > deadline:
+                retransmit_timer.cancel()
+                retransmit_timer = None
+            if retransmit_timer is None:
+                retransmit_timer = loop.call_at(deadline, on_retransmit)
+        if input_done and not input_values and not outstanding and end_timer is None:
+            send_end()
+
+    def on_decided(group, msg, current_time):
+        nonlocal last_ack_time, window
+        seqs, ends = client_entries(msg.payload, client_id)
+        for seq in seqs:
+            if (group, seq) in outstanding:
+                value, first_sent, last_sent = outstanding.pop((group, seq))
+                latencies.append(current_time - first_sent)
+                metrics.observe('client.commit', current_time - first_sent)
+                last_ack_time = current_time
+                if first_sent == last_sent:  # Never retransmitted, so an unambiguous sample
+                    decision_rtt.sample(current_time - first_sent)
+                    window = min(window + 1 / window, WINDOW)
+        for end in ends:
+            if end.count == group_values_sent[group] and end_timer:
+                ended.add(group)
+                if len(ended) == GROUPS:
+                    finish()
+                    return
+
+    handlers = {
+        DECISION: on_decided,
+        CLIENT_ACK: on_decided,
+    }
+
+    def on_datagram(group, data, current_time):
+        for msg in decode_messages(data):
+            if finished:
+                return
+            handler = handlers.get(msg.type)
+            if handler:
+                handler(group, msg, current_time)
 
+    def report_progress():
+        logger.info("Client %d: Sent %d values so far, %d outstanding", client_id, values_sent, len(outstanding))
+
+    def finish():
+        nonlocal finished
+        finished = True
+        for timer in (retransmit_timer, end_timer, report_timer):
+            if timer:
+                timer.cancel()
+        pause_input()
+        for client_socket in client_sockets:
+            loop.remove_reader(client_socket)
+
+        if latencies:
+            latencies.sort()
+            elapsed_time = max(last_ack_time - first_send_time, 1e-6)
+
+            def percentile(p):
+                return latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] * 1000
+
+            logger.info("Client %d: Finished. %d values decided in %.2f seconds (%.2f values/second, %d retransmissions)",
+                        client_id, len(latencies), elapsed_time, len(latencies) / elapsed_time, retransmissions)
+            logger.info("Client %d: Latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f",
+                        client_id, percentile(50), percentile(90), percentile(99), latencies[-1] * 1000)
+
+    metrics.gauge('client.outstanding', lambda: len(outstanding))
+    metrics.gauge('client.window', lambda: int(window))
+    for group, client_socket in enumerate(client_sockets):
+        loop.add_datagram_reader(client_socket, lambda data, current_time, group=group: on_datagram(group, data, current_time),
+                                 on_drained=progress)
+    report_timer = loop.call_every(1.0, report_progress)
+    progress(loop.time())
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python3 mypaxos.py <role> <id> <config_file>", file=sys.stderr)
+        print("Usage: python3 mypaxos.py <role>[,<role>...] <id> <config_file> [group]", file=sys.stderr)
         sys.exit(1)
-    
-    role = sys.argv[1]
+
+    roles = sys.argv[1].split(",")
     node_id = int(sys.argv[2])
     config_file = sys.argv[3]
-    
+    only_group = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="%(message)s")
     CONFIG = load_config(config_file)
+    logger.setLevel(str(CONFIG.get('log_level', 'info')).upper())
+    GROUPS = CONFIG.get('groups', 1)
+
+    # Several roles can share one process and one event loop, e.g. "acceptor,learner"
+    role_functions = {
+        "proposer": proposer,
+        "acceptor": acceptor,
+        "learner": learner,
+        "client": client,
+    }
+    GROUP_ROLES = ("proposer", "acceptor")  # Learners and clients follow every group
+
+    def run(roles, group):
+        loop = EventLoop()
+        for role in roles:
+            role_functions[role](group_config(CONFIG, group) if role in GROUP_ROLES else CONFIG, node_id, loop)
+        # Each process answers on its own port: stats_port + 1000 * group + 100 * role index + id,
+        # e.g. acceptor 2 of group 0 on stats_port + 102
+        stats_port = CONFIG.get('stats_port')
+        if stats_port:
+            stats_port += 1000 * group + 100 * list(role_functions).index(roles[0]) + node_id
+        loop.serve_stats(CONFIG.get('stats_interval', 0), stats_port)
+        loop.run()
 
-    if role == "proposer":
-        proposer(CONFIG, node_id)
-    elif role == "acceptor":
-        acceptor(CONFIG, node_id)
-    elif role == "learner":
-        learner(CONFIG, node_id)
-    elif role == "client":
-        client(CONFIG, node_id)
\ No newline at end of file
+    # With groups > 1 the proposer and acceptor of every group run in a process of their
+    # own, so the groups use as many cores, unless the command line names the group
+    group_roles = [role for role in roles if role in GROUP_ROLES]
+    if GROUPS > 1 and group_roles and only_group is None:
+        children = []
+        for group in range(GROUPS):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    run(group_roles, group)
+                    status = 0
+                except Exception:
+                    logger.exception("Group %d: %s failed", group, ",".join(group_roles))
+                finally:
+                    os._exit(status)
+            children.append(pid)
+        other_roles = [role for role in roles if role not in GROUP_ROLES]
+        if other_roles:
+            run(other_roles, 0)
+        failed = False
+        for group, pid in enumerate(children):
+            status = os.waitpid(pid, 0)[1]
+            if os.WIFSIGNALED(status):
+                logger.error("Group %d: %s process killed by signal %d", group, ",".join(group_roles),
+                             os.WTERMSIG(status))
+                failed = True
+            elif os.WEXITSTATUS(status):
+                logger.error("Group %d: %s process exited with status %d", group, ",".join(group_roles),
+                             os.WEXITSTATUS(status))
+                failed = True
+        if failed:
+            sys.exit(1)
+    else:
+        run(roles, only_group or 0)
@@ -0,0 +1,394 @@
+"""Deterministic in-process simulation of a cluster, and a benchmark suite on top of it.
+
+The proposer, acceptor, learner and client functions of mypaxos.py run
+unchanged against SimulatedLoop. The network is a set of multicast groups
+with seeded loss, delay, duplication and reordering, and time is virtual:
+a scenario that takes minutes with run.sh runs in seconds, and reusing its
+seed replays it exactly.
+
+Usage: python3 simulate.py [values per client] [seed] [scenario ...]
+"""
+import contextlib
+import glob
+import heapq
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from collections import deque, namedtuple
+
+from mypaxos import (CLIENT_VALUE, DECISION, PHASE1B, PHASE2A, PHASE2B, FLAG_ANY, WAL_ACCEPT, AcceptorLog, End,
+                     EventLoop, decode_batch, decode_messages, quorum_sizes, fast_quorum_size, group_config,
+                     proposer, acceptor, learner, client)
+
+
+# loss: chance that a receiver misses a datagram; delay + up to jitter: one-way
+# latency in seconds; duplicate: chance a datagram arrives twice; reorder:
+# chance it is held back long enough to arrive after later datagrams
+Network = namedtuple('Network', 'loss delay jitter duplicate reorder')
+
+REORDER_DELAY = 0.005
+
+ADDRESSES = {
+    'proposers': ('239.0.0.1', 6000),
+    'acceptors': ('239.0.0.1', 7000),
+    'learners': ('239.0.0.1', 8000),
+    'client': ('239.0.0.1', 9000),
+}
+
+
+class SimulatedSocket:
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = deque()  # Datagrams delivered but not read yet
+        self.reader = None  # (on_datagram, on_drained, limit)
+        self.draining = False
+
+    def sendto(self, data, address):
+        self.loop.transmit(data, address)
+
+
+class SimulatedLoop(EventLoop):
+    """EventLoop with virtual time whose sockets are joined by a simulated network"""
+
+    def __init__(self, network, seed):
+        super().__init__()
+        self.now = 0.0
+        self.network = network
+        self.random = random.Random(seed)
+        self.groups = {}  # group address -> sockets that joined it
+        self.readers = set()
+        self.taps = []  # tap(data, address, time) sees every datagram sent
+        self.datagrams_sent = 0
+        self.errors = []
+
+    def time(self):
+        return self.now
+
+    def open_socket(self, group=None):
+        sock = SimulatedSocket(self)
+        if group:
+            self.groups.setdefault(tuple(group), []).append(sock)
+        return sock
+
+    def add_reader(self, fileobj, callback, daemon=False):
+        raise TypeError(f"Cannot watch {fileobj!r}: only datagram sockets are simulated, "
+                        "through add_datagram_reader (clients get their values as a list, not from stdin)")
+
+    def add_datagram_reader(self, sock, on_datagram, on_drained=None, limit=EventLoop.DRAIN_LIMIT):
+        sock.reader = (on_datagram, on_drained, limit)
+        self.readers.add(sock)
+
+    def remove_reader(self, sock):
+        sock.reader = None
+        self.readers.discard(sock)
+
+    def transmit(self, data, address):
+        self.datagrams_sent += 1
+        for tap in self.taps:
+            tap(data, address, self.now)
+        network = self.network
+        for sock in self.groups.get(tuple(address), ()):
+            copies = 2 if self.random.random() < network.duplicate else 1
+            for _ in range(copies):
+                if self.random.random() < network.loss:
+                    continue
+                delay = network.delay + self.random.random() * network.jitter
+                if self.random.random() < network.reorder:
+                    delay += REORDER_DELAY
+                self.call_at(self.now + delay, lambda sock=sock: self.deliver(sock, data))
+
+    def deliver(self, sock, data):
+        if sock.reader is None:
+            return  # Nobody listens on this socket anymore
+        sock.queue.append(data)
+        if not sock.draining:
+            # Datagrams arriving at the same instant are read in one go, as after a select
+            sock.draining = True
+            self.call_at(self.now, lambda: self.drain(sock))
+
+    def drain(self, sock):
+        sock.draining = False
+        if sock.reader is None:
+            return
+        on_datagram, on_drained, limit = sock.reader
+        for _ in range(min(limit, len(sock.queue))):
+            self.syscalls['recvfrom_into'] += 1
+            self.guard(on_datagram, sock.queue.popleft(), self.now)
+            if sock.reader is None:
+                return
+        if on_drained:
+            self.guard(on_drained, self.now)
+        if sock.queue and not sock.draining:
+            sock.draining = True
+            self.call_at(self.now, lambda: self.drain(sock))
+
+    def guard(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            self.errors.append(traceback.format_exc())
+
+    def run(self, time_limit, done=None):
+        """Run the events in virtual time order until done() holds, no reader is left
+        or time_limit virtual seconds have passed"""
+        self.flush()
+        while self.readers and self.timers:
+            timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            if timer.when > time_limit:
+                break
+            self.now = max(self.now, timer.when)
+            if timer.interval is not None:
+                timer.when += timer.interval
+                heapq.heappush(self.timers, timer)
+            self.guard(timer.callback)
+            self.flush()  # As the real loop does before it waits again
+            if done and done():
+                break
+
+
+# restart: acceptor 1 keeps a write-ahead log in a temporary wal_dir, crashes once half
+# the values are decided, and starts again from its log, whose last record is torn,
+# RESTART_DOWNTIME later
+Scenario = namedtuple('Scenario', 'name network settings catch_up restart', defaults=(False,))
+
+SCENARIOS = [
+    Scenario("no loss", Network(0.0, 0.0005, 0.0002, 0.0, 0.0), {}, False),
+    Scenario("10% loss", Network(0.1, 0.0005, 0.0002, 0.01, 0.01), {}, False),
+    Scenario("catch-up", Network(0.0, 0.0005, 0.0002, 0.0, 0.0), {}, True),
+    Scenario("dueling proposers", Network(0.0, 0.0005, 0.0002, 0.0, 0.0), {'stable_leader': 0}, False),
+    Scenario("direct votes", Network(0.0, 0.0005, 0.0002, 0.0, 0.0), {'direct_votes': 1}, False),
+    Scenario("direct votes 10% loss", Network(0.1, 0.0005, 0.0002, 0.01, 0.01), {'direct_votes': 1}, False),
+    Scenario("5 acceptors, Q2=2", Network(0.0, 0.0005, 0.0002, 0.0, 0.0),
+             {'acceptor_count': 5, 'phase2_quorum': 2}, False),
+    Scenario("fast paxos", Network(0.0, 0.0005, 0.0002, 0.0, 0.0), {'fast_paxos': 1, 'client_window': 1}, False),
+    Scenario("fast paxos 2% loss", Network(0.02, 0.0005, 0.0002, 0.01, 0.01), {'fast_paxos': 1}, False),
+    Scenario("4 groups", Network(0.0, 0.0005, 0.0002, 0.0, 0.0), {'groups': 4}, False),
+    Scenario("2 groups 10% loss", Network(0.1, 0.0005, 0.0002, 0.01, 0.01), {'groups': 2, 'partition': 'key'}, False),
+    Scenario("checkpoints", Network(0.05, 0.0005, 0.0002, 0.01, 0.01), {'checkpoint_interval': 10}, True),
+    Scenario("acceptor restart", Network(0.01, 0.0005, 0.0002, 0.01, 0.01), {}, False, restart=True),
+]
+
+CLIENT_START = 2.0  # Virtual seconds: proposers elect a leader first, as in run.sh
+RESTART_DOWNTIME = 0.05
+TIME_LIMIT = 300.0
+
+
+def tear_log(directory, instance):
+    """Append the first part of an ACCEPT record for instance to the current log in
+    directory, as a crash in the middle of a write leaves it. Returns the log's file
+    name and its size before."""
+    log_path = max(glob.glob(os.path.join(directory, "log.*")), key=lambda path: int(path.rsplit(".", 1)[1]))
+    size = os.path.getsize(log_path)
+    with open(log_path, "ab") as log:
+        log.write(AcceptorLog._record(WAL_ACCEPT, instance, 1, b"torn" * 32)[:-40])
+    return os.path.basename(log_path), size
+
+
+def check_recovery(directory, torn_instance, promises, votes, proposals):
+    """Recover a copy of the write-ahead log of a crashed acceptor and compare it with
+    what the acceptor answered before: every promise and vote it sent must be on disk,
+    and the torn record at the end must be gone. Returns the differences found."""
+    problems = []
+    with tempfile.TemporaryDirectory(prefix="simulate-") as scratch:
+        copy = os.path.join(scratch, "acceptor")
+        shutil.copytree(directory, copy)
+        wal = AcceptorLog(copy)
+        try:
+            recovered = {instance: (promised, accepted) for instance, promised, accepted in wal.rounds()}
+            if torn_instance in recovered:
+                problems.append("the torn record at the end of the log was replayed")
+            for instance, rnd in promises:
+                promised = recovered.get(instance, (0, 0))[0]
+                if instance >= wal.leader_from:
+                    promised = max(promised, wal.leader_rnd)
+                if instance >= wal.base and promised < rnd:
+                    problems.append(f"promise of round {rnd} for instance {instance} was lost")
+            for instance, rnd in votes.items():
+                if instance < wal.base:
+                    continue  # Truncated below a checkpoint
+                accepted = recovered.get(instance, (0, 0))[1]
+                if accepted < rnd:
+                    problems.append(f"accept of round {rnd} in instance {instance} was lost")
+                elif accepted == rnd and wal.value(instance) != proposals.get((instance, rnd)):
+                    problems.append(f"accepted value of instance {instance} differs")
+        finally:
+            wal.close()
+    return problems
+
+
+def run_scenario(scenario, values_per_client, seed):
+    config = dict(ADDRESSES, **scenario.settings)
+    wal_dir = None
+    if scenario.restart:
+        wal_dir = config['wal_dir'] = tempfile.mkdtemp(prefix="simulate-wal-")
+    loop = SimulatedLoop(scenario.network, seed)
+    rng = random.Random(seed)
+    values = {client_id: [str(rng.randrange(32768)) for _ in range(values_per_client)]  # Like generate.sh
+              for client_id in (1, 2)}
+    outputs = {1: io.StringIO(), 2: io.StringIO()}
+
+    # Commit latency: first time a request is sent to the proposers until the
+    # first DECISION that carries it goes out to the learners, or with direct votes
+    # and fast rounds the vote that makes a quorum. Datagrams and socket calls (sends
+    # and receives) are counted from the first request to the last decision.
+    # Requests and instances are numbered per group.
+    groups = config.get('groups', 1)
+    configs = [group_config(config, group) if groups > 1 else config for group in range(groups)]
+    submit_groups = {configs[group][role]: group for group in range(groups) for role in ('proposers', 'acceptors')}
+    learner_groups = {configs[group]['learners']: group for group in range(groups)}
+    submitted = {}
+    decided = {}
+    decided_instances = set()
+    counts = [(0, 0), (0, 0)]  # (datagrams sent, socket calls) before the first request and up to the last decision
+    proposals = {}  # (group, instance, round) -> batch sent to the learners
+    votes = {}  # (group, instance, round, value in a fast round) -> acceptors that sent their vote to the learners
+    acceptor_count, _, phase2_quorum = quorum_sizes(config)
+    fast_quorum = fast_quorum_size(config)
+    # Restart: what acceptor 1 of group 0 promised and voted for before it crashed
+    restart_sock = []  # Its socket, until it crashes
+    restart_promises = set()  # (instance, round)
+    restart_votes = {}  # instance -> highest round voted in
+    restart_proposals = {}  # (instance, round) -> batch proposed to the acceptors
+
+    def decide(group, instance, payload, now):
+        if (group, instance) in decided_instances:
+            return
+        decided_instances.add((group, instance))
+        for entry in decode_batch(payload):
+            if not isinstance(entry, End):
+                decided.setdefault((group, entry.client_id, entry.seq), now)
+        counts[1] = (loop.datagrams_sent, sum(loop.syscalls.values()))
+
+    def tap(data, address, now):
+        for msg in decode_messages(data):
+            if restart_sock:
+                record_for_restart(msg, address)
+                if len(decided) >= values_per_client:
+                    loop.call_at(now, crash_acceptor)
+            if msg.type == CLIENT_VALUE:
+                if not submitted:
+                    counts[0] = (loop.datagrams_sent - 1, sum(loop.syscalls.values()) - 1)
+                submitted.setdefault((submit_groups[address], msg.sender, msg.aux), now)
+                continue
+            group = learner_groups.get(address)
+            if group is None:
+                continue
+            slot = (group, msg.instance, msg.ballot)
+            if msg.type == DECISION and msg.payload:
+                decide(group, msg.instance, msg.payload, now)
+            elif msg.type == PHASE2A:
+                proposals[slot] = msg.payload
+            elif msg.type == PHASE2B:
+                voters = votes.setdefault(slot + (msg.payload,), set())
+                voters.add(msg.sender)
+                if msg.payload and len(voters) == fast_quorum:
+                    decide(group, msg.instance, msg.payload, now)
+                elif len(voters) == phase2_quorum and slot in proposals:
+                    decide(group, msg.instance, proposals[slot], now)
+            elif msg.type == DECISION and slot in proposals:
+                decide(group, msg.instance, proposals[slot], now)
+
+    def record_for_restart(msg, address):
+        if address == configs[0]['acceptors'] and msg.type == PHASE2A and not msg.flags & FLAG_ANY:
+            restart_proposals[(msg.instance, msg.ballot)] = msg.payload
+        elif address == configs[0]['proposers'] and msg.sender == 1:
+            if msg.type == PHASE1B:
+                restart_promises.add((msg.instance, msg.ballot))
+            elif msg.type == PHASE2B:
+                restart_votes[msg.instance] = max(restart_votes.get(msg.instance, 0), msg.ballot)
+
+    loop.taps.append(tap)
+
+    def crash_acceptor():
+        if not restart_sock:
+            return  # Already crashed
+        # Replies only leave once their records are synced: nothing more is written
+        loop.remove_reader(restart_sock.pop())
+        directory = os.path.join(wal_dir, "acceptor-1")
+        torn_instance = 1 + max([instance for instance, _ in restart_promises] + list(restart_votes) + [0])
+        log_name, intact_size = tear_log(directory, torn_instance)
+        for problem in check_recovery(directory, torn_instance, restart_promises, restart_votes, restart_proposals):
+            loop.errors.append(f"Acceptor 1 recovery: {problem}")
+        # The restarted acceptor cuts the torn record off itself
+        loop.call_later(RESTART_DOWNTIME, lambda: restart_acceptor(directory, log_name, intact_size))
+
+    def restart_acceptor(directory, log_name, intact_size):
+        acceptor(configs[0], 1, loop)
+        if os.path.getsize(os.path.join(directory, log_name)) != intact_size:
+            loop.errors.append("Acceptor 1 recovery: the torn record at the end of the log was not cut off")
+
+    def learners_done():
+        sockets = [sock for address in learner_groups for sock in loop.groups.get(address, ())]
+        return len(sockets) == 2 * groups and not any(sock.reader for sock in sockets)
+
+    wall_start = time.time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        for group_settings in configs:
+            for acceptor_id in range(1, acceptor_count + 1):
+                acceptor(group_settings, acceptor_id, loop)
+        if scenario.restart:
+            restart_sock.append(loop.groups[tuple(configs[0]['acceptors'])][0])  # Acceptor 1 of group 0
+        learner(config, 1, loop, outputs[1])
+        for group_settings in configs:
+            for proposer_id in (1, 2):
+                proposer(group_settings, proposer_id, loop)
+        loop.call_at(CLIENT_START, lambda: client(config, 1, loop, values[1]))
+        if scenario.catch_up:
+            # As in run_catch_up.sh: learner 2 only starts after client 1 went through
+            loop.call_at(CLIENT_START + 1.0, lambda: learner(config, 2, loop, outputs[2]))
+            loop.call_at(CLIENT_START + 1.5, lambda: client(config, 2, loop, values[2]))
+        else:
+            learner(config, 2, loop, outputs[2])
+            loop.call_at(CLIENT_START, lambda: client(config, 2, loop, values[2]))
+        loop.run(TIME_LIMIT, learners_done)
+    wall_time = time.time() - wall_start
+    if wal_dir:
+        shutil.rmtree(wal_dir, ignore_errors=True)
+
+    learned = [outputs[learner_id].getvalue().splitlines() for learner_id in (1, 2)]
+    proposed = sorted(values[1] + values[2])
+    agree = learned[0] == learned[1]
+    complete = all(sorted(output) == proposed for output in learned)
+
+    latencies = sorted(decided[request] - submitted[request] for request in decided if request in submitted)
+    if latencies:
+        elapsed = max(max(decided.values()) - min(submitted.values()), 1e-9)
+        throughput = len(latencies) / elapsed
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) * 99 // 100, len(latencies) - 1)] * 1000
+    else:
+        throughput = p50 = p99 = 0.0
+    datagrams = (counts[1][0] - counts[0][0]) / max(len(decided_instances), 1)  # All groups together
+    syscalls = (counts[1][1] - counts[0][1]) / max(len(decided), 1)
+
+    finished = learners_done() and loop.now < TIME_LIMIT
+    status = "ok" if finished and agree and complete and not loop.errors else "FAIL"
+    print(f"{scenario.name:<22}{throughput:>10.0f}{p50:>8.1f}{p99:>8.1f}{datagrams:>12.1f}{syscalls:>12.1f}"
+          f"{loop.now:>8.1f}{wall_time:>8.1f}  {status}")
+    for error in loop.errors[:3]:
+        print(error, file=sys.stderr)
+    return status == "ok"
+
+
+def main():
+    values_per_client = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    names = sys.argv[3:]
+    scenarios = [scenario for scenario in SCENARIOS if not names or scenario.name in names]
+
+    print(f"{values_per_client} values per client, seed {seed}; throughput and latency in virtual time")
+    print(f"{'scenario':<22}{'values/s':>10}{'p50 ms':>8}{'p99 ms':>8}{'dgrams/inst':>12}{'calls/value':>12}"
+          f"{'sim s':>8}{'wall s':>8}  result")
+    results = [run_scenario(scenario, values_per_client, seed) for scenario in scenarios]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()